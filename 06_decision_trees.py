@@ -812,6 +812,254 @@ y_pred_majority_votes, n_votes = mode(Y_pred, axis=0)
 accuracy_score(y_test, y_pred_majority_votes.reshape([-1]))
 
 
+# Extra material: training these 1,000 trees one after the other only uses a single CPU core, and the `mini_sets` list holds 1,000 copies of the training instances. Instead, we can keep a single copy of the training set and send each worker process only the indices of its instances. Joblib memory-maps any array passed to the workers (since we set `max_nbytes=0`), so all the workers share the same copy of `X_train` and `y_train`. To limit the inter-process communication overhead, each task trains a whole batch of trees rather than a single tree.
+
+# In[59]:
+
+
+from joblib import Parallel, delayed, effective_n_jobs
+
+def fit_trees(estimators, X, y, subset_indices):
+    for estimator, indices in zip(estimators, subset_indices):
+        estimator.fit(X[indices], y[indices])
+    return estimators
+
+def fit_forest(estimator, X, y, subset_indices, n_jobs=-1):
+    n_batches = min(effective_n_jobs(n_jobs), len(subset_indices))
+    batches = np.array_split(np.arange(len(subset_indices)), n_batches)
+    fitted_batches = Parallel(n_jobs=n_jobs, max_nbytes=0)(
+        delayed(fit_trees)([clone(estimator) for _ in batch], X, y,
+                           [subset_indices[i] for i in batch])
+        for batch in batches)
+    return [tree for fitted_trees in fitted_batches for tree in fitted_trees]
+
+
+# The subsets are defined by the same `ShuffleSplit` as above, and the trees are clones of the same estimator (including its `random_state`), so we get exactly the same 1,000 trees:
+
+# In[60]:
+
+
+subset_indices = [mini_train_index
+                  for mini_train_index, _ in rs.split(X_train)]
+parallel_forest = fit_forest(grid_search_cv.best_estimator_, X_train, y_train,
+                             subset_indices)
+
+
+# Predictions can also be computed in parallel, one block of trees per task. Each task writes its trees' predictions in a single `Y_pred` block, then the blocks are stacked:
+
+# In[61]:
+
+
+def predict_trees(trees, X):
+    Y_pred_block = np.empty([len(trees), len(X)], dtype=np.uint8)
+    for tree_index, tree in enumerate(trees):
+        Y_pred_block[tree_index] = tree.predict(X)
+    return Y_pred_block
+
+def predict_forest(forest, X, n_jobs=-1):
+    n_blocks = min(effective_n_jobs(n_jobs), len(forest))
+    blocks = np.array_split(np.arange(len(forest)), n_blocks)
+    Y_pred_blocks = Parallel(n_jobs=n_jobs, max_nbytes=0)(
+        delayed(predict_trees)([forest[i] for i in block], X)
+        for block in blocks)
+    return np.concatenate(Y_pred_blocks)
+
+
+# Lastly, rather than calling `mode()`, we can count the votes for every test instance in a single call to `np.bincount()`: we just need to offset the class indices of each column (i.e., each instance) so that every column gets its own range of bins. In case of a tie, `argmax()` picks the smallest class index, just like `mode()` does:
+
+# In[62]:
+
+
+def majority_vote(Y_pred, n_classes=None):
+    if n_classes is None:
+        n_classes = int(Y_pred.max()) + 1
+    n_instances = Y_pred.shape[1]
+    offsets = np.arange(n_instances) * n_classes
+    votes = np.bincount((Y_pred + offsets).ravel(),
+                        minlength=n_instances * n_classes)
+    return votes.reshape(n_instances, n_classes).argmax(axis=1)
+
+
+# In[63]:
+
+
+Y_pred_parallel = predict_forest(parallel_forest, X_test)
+y_pred_parallel_votes = majority_vote(Y_pred_parallel)
+accuracy_score(y_test, y_pred_parallel_votes)
+
+
+# We get exactly the same predictions as earlier:
+
+# In[64]:
+
+
+(y_pred_parallel_votes == y_pred_majority_votes.reshape([-1])).all()
+
+
+# Let's compare the training time of the sequential and parallel versions. The speedup depends on the number of CPU cores on your machine (on a single core, the parallel version is a bit slower because of the extra overhead):
+
+# In[65]:
+
+
+get_ipython().run_line_magic('timeit', '[clone(grid_search_cv.best_estimator_).fit(X_mini_train, y_mini_train) for X_mini_train, y_mini_train in mini_sets]')
+get_ipython().run_line_magic('timeit', 'fit_forest(grid_search_cv.best_estimator_, X_train, y_train, subset_indices)')
+
+
+# # Extra Material – Compiling a forest for fast inference
+
+# Calling each tree's `predict()` method means 1,000 separate calls, each with its own input validation and overhead. Since a tree is just a few NumPy arrays (as we saw earlier in the extra material on the tree structure), we can instead concatenate all the trees into a single node table, then traverse all the trees for a whole batch of instances at once using NumPy fancy indexing. Leaves point back to themselves, which makes it easy to detect the (tree, instance) pairs that have reached a leaf: we can stop updating them. The node indices are stored as 32-bit integers, the feature indices as 16-bit integers (when possible) and the leaf classes as 8-bit integers. The thresholds stay 64-bit floats, since rounding them to 32 bits could change the outcome of some comparisons:
+
+# In[66]:
+
+
+from collections import namedtuple
+
+CompiledForest = namedtuple(
+    "CompiledForest",
+    ["feature", "threshold", "left", "right", "proba", "leaf_class", "roots",
+     "max_depth", "classes"])
+
+def compile_forest(trees):
+    trees = getattr(trees, "estimators_", trees)  # also accept an ensemble
+    n_features = trees[0].n_features_in_
+    feature_dtype = np.int16 if n_features <= np.iinfo(np.int16).max else np.int32
+    features, thresholds, lefts, rights, probas = [], [], [], [], []
+    roots, offset = [], 0
+    for tree_clf in trees:
+        tree = tree_clf.tree_
+        node_ids = np.arange(tree.node_count, dtype=np.int32) + offset
+        is_leaf = tree.children_left == tree.children_right
+        features.append(np.where(is_leaf, 0, tree.feature))
+        thresholds.append(tree.threshold)
+        lefts.append(np.where(is_leaf, node_ids, tree.children_left + offset))
+        rights.append(np.where(is_leaf, node_ids, tree.children_right + offset))
+        proba = tree.value[:, 0, :tree_clf.n_classes_]
+        normalizer = proba.sum(axis=1, keepdims=True)  # same as predict_proba()
+        normalizer[normalizer == 0.0] = 1.0
+        probas.append(proba / normalizer)
+        roots.append(offset)
+        offset += tree.node_count
+    proba = np.concatenate(probas)
+    return CompiledForest(
+        feature=np.concatenate(features).astype(feature_dtype),
+        threshold=np.concatenate(thresholds),
+        left=np.concatenate(lefts).astype(np.int32),
+        right=np.concatenate(rights).astype(np.int32),
+        proba=proba,
+        leaf_class=proba.argmax(axis=1).astype(np.uint8),
+        roots=np.array(roots, dtype=np.int32),
+        max_depth=max(tree_clf.tree_.max_depth for tree_clf in trees),
+        classes=trees[0].classes_)
+
+
+# To find the leaf reached by every (tree, instance) pair, we start from the root nodes, and at each step we gather the feature and threshold of the current nodes, and move to the left or right child. Pairs that have reached a leaf are dropped from the active set, so deep but unbalanced trees don't cost much more than shallow ones. Scikit-Learn converts the inputs to 32-bit floats before comparing them to the thresholds, so we must do the same to get identical results. The instances are processed in batches to keep the _n_<sub>trees</sub> × _batch_size_ index arrays small:
+
+# In[67]:
+
+
+def compiled_forest_leaves(compiled_forest, X):
+    X = np.asarray(X, dtype=np.float32)
+    n_trees, n_instances = len(compiled_forest.roots), len(X)
+    nodes = np.repeat(compiled_forest.roots, n_instances)
+    rows = np.tile(np.arange(n_instances), n_trees)
+    active = np.arange(nodes.size)  # (tree, instance) pairs not at a leaf yet
+    for _ in range(compiled_forest.max_depth):
+        current = nodes[active]
+        go_left = (X[rows[active], compiled_forest.feature[current]]
+                   <= compiled_forest.threshold[current])
+        nodes[active] = np.where(go_left, compiled_forest.left[current],
+                                 compiled_forest.right[current])
+        active = active[nodes[active] != current]
+    return nodes.reshape(n_trees, n_instances)
+
+def compiled_forest_predict_votes(compiled_forest, X, batch_size=1000):
+    Y_pred = np.empty([len(compiled_forest.roots), len(X)], dtype=np.uint8)
+    for start in range(0, len(X), batch_size):
+        leaves = compiled_forest_leaves(compiled_forest,
+                                        X[start:start + batch_size])
+        Y_pred[:, start:start + batch_size] = compiled_forest.leaf_class[leaves]
+    return Y_pred
+
+def compiled_forest_predict_proba(compiled_forest, X, batch_size=1000):
+    y_proba = np.empty([len(X), compiled_forest.proba.shape[1]])
+    for start in range(0, len(X), batch_size):
+        leaves = compiled_forest_leaves(compiled_forest,
+                                        X[start:start + batch_size])
+        y_proba[start:start + batch_size] = (
+            compiled_forest.proba[leaves].sum(axis=0) / len(leaves))
+    return y_proba
+
+
+# Let's compile the 1,000 trees of the previous exercise, and check that the hard votes are identical to the ones we got earlier:
+
+# In[68]:
+
+
+compiled_forest = compile_forest(forest)
+Y_pred_compiled = compiled_forest_predict_votes(compiled_forest, X_test)
+(Y_pred_compiled == Y_pred).all()
+
+
+# In[69]:
+
+
+y_pred_compiled_votes = majority_vote(Y_pred_compiled)
+accuracy_score(y_test, y_pred_compiled_votes)
+
+
+# It also works with a `RandomForestClassifier`, which averages the trees' estimated class probabilities (i.e., soft voting):
+
+# In[70]:
+
+
+from sklearn.ensemble import RandomForestClassifier
+
+rnd_clf = RandomForestClassifier(n_estimators=500, random_state=42)
+rnd_clf.fit(X_train, y_train)
+compiled_rnd_clf = compile_forest(rnd_clf)
+y_proba_compiled = compiled_forest_predict_proba(compiled_rnd_clf, X_test)
+y_pred_compiled = compiled_rnd_clf.classes[y_proba_compiled.argmax(axis=1)]
+((y_pred_compiled == rnd_clf.predict(X_test)).all(),
+ np.allclose(y_proba_compiled, rnd_clf.predict_proba(X_test)))
+
+
+# Now let's compare the prediction time. On large batches, Scikit-Learn's optimized Cython code remains faster than our pure NumPy traversal (you would need a JIT compiler such as Numba to beat it), but on small batches—for example when serving predictions online—it avoids the overhead of hundreds of separate `predict()` calls, so the latency drops dramatically:
+
+# In[71]:
+
+
+get_ipython().run_line_magic('timeit', 'np.array([tree.predict(X_test) for tree in forest])')
+get_ipython().run_line_magic('timeit', 'compiled_forest_predict_votes(compiled_forest, X_test)')
+get_ipython().run_line_magic('timeit', 'np.array([tree.predict(X_test[:10]) for tree in forest])')
+get_ipython().run_line_magic('timeit', 'compiled_forest_predict_votes(compiled_forest, X_test[:10])')
+
+
+# In[72]:
+
+
+get_ipython().run_line_magic('timeit', 'rnd_clf.predict_proba(X_test)')
+get_ipython().run_line_magic('timeit', 'compiled_forest_predict_proba(compiled_rnd_clf, X_test)')
+get_ipython().run_line_magic('timeit', 'rnd_clf.predict_proba(X_test[:10])')
+get_ipython().run_line_magic('timeit', 'compiled_forest_predict_proba(compiled_rnd_clf, X_test[:10])')
+
+
+# As for the memory footprint, the compiled forest is a handful of contiguous arrays, whereas each Scikit-Learn tree is a separate Python object with its own (larger) node structure:
+
+# In[73]:
+
+
+import pickle
+
+def compiled_forest_nbytes(compiled_forest):
+    return sum(field.nbytes for field in compiled_forest
+               if isinstance(field, np.ndarray))
+
+for trees, compiled in ((forest, compiled_forest),
+                        (rnd_clf, compiled_rnd_clf)):
+    print(f"Pickled trees: {len(pickle.dumps(trees)) / 1e6:.1f} MB, "
+          f"compiled forest: {compiled_forest_nbytes(compiled) / 1e6:.1f} MB")
+
+
 # In[ ]:
 
 
@@ -904,6 +904,606 @@ stack_clf.score(X_test, y_test)
 # * Since we could reclaim the validation set, the `StackingClassifier` was trained on a larger dataset.
 # * It used `predict_proba()` if available, or else `decision_function()` if available, or else `predict()`. This gave the blender much more nuanced inputs to work with.
 
+# # Extra Material – Histogram-Based Gradient Boosting from Scratch
+
+# Earlier in this chapter, we trained `tree_reg1`, `tree_reg2` and `tree_reg3` on successive residuals, and `plot_predictions()` summed the predictions of all the trees every time. Let's generalize this into a small gradient boosting engine, using the same tricks as `HistGradientBoostingRegressor`:
+# 
+# * The features are binned only once, before training: each value is replaced with the index of its quantile bin, stored as a `uint8`. The bin edges are computed on the non-missing values only, and missing values (NaN) get a bin of their own, number 255, which is reserved for them (so `max_bins` can be at most 255). Since a split sends the bins lower than or equal to its threshold to the left child, and the threshold is always lower than 255, the instances with a missing value always go to the right child.
+# * Each tree is grown from gradient histograms: for each feature and each bin, we just need the sum of the gradients and the number of instances. Finding the best split is then a matter of computing cumulative sums over the bins.
+# * When a node is split, we only compute the histograms of the smallest child: the other child's histograms are equal to the parent's histograms minus the smallest child's (this is called the _subtraction trick_).
+# * The predictions on the training set and on the validation set are updated incrementally after each tree, rather than summing all the trees' predictions every time.
+# * Training stops when the validation RMSE has not improved for `n_iter_no_change` iterations, and the ensemble is truncated to the best iteration.
+# 
+# With the squared error loss, the gradient of each instance is simply its prediction minus its target, so each leaf predicts the (regularized) mean residual of its instances, just like `tree_reg2` and `tree_reg3` above.
+
+# In[73]:
+
+
+MISSING_BIN = 255  # the last value a uint8 can take is reserved for NaNs
+
+def compute_bin_edges(X, max_bins=255, subsample=200_000, random_state=42):
+    if max_bins > MISSING_BIN:
+        raise ValueError(f"max_bins must be at most {MISSING_BIN}")
+    if len(X) > subsample:
+        rng = np.random.default_rng(random_state)
+        X = X[rng.choice(len(X), subsample, replace=False)]
+    bin_edges = []
+    for column in X.T:
+        column = column[~np.isnan(column)]
+        distinct_values = np.unique(column)
+        if len(distinct_values) <= max_bins:
+            edges = (distinct_values[:-1] + distinct_values[1:]) / 2
+        else:
+            percentiles = np.linspace(0, 100, max_bins + 1)[1:-1]
+            edges = np.unique(np.percentile(column, percentiles))
+        bin_edges.append(edges)
+    return bin_edges
+
+def bin_features(X, bin_edges):
+    X_binned = np.empty(X.shape, dtype=np.uint8)
+    for feature_idx, edges in enumerate(bin_edges):
+        column = X[:, feature_idx]
+        X_binned[:, feature_idx] = np.where(
+            np.isnan(column), MISSING_BIN,
+            np.searchsorted(edges, column, side="right"))
+    return X_binned
+
+
+# The histograms of all the features are computed in a single call to `np.bincount()`, by offsetting the bin indices of each feature (the same trick as in the "grow a forest" exercise of chapter 6):
+
+# In[74]:
+
+
+N_BINS = 256  # all the values a uint8 can take
+
+def compute_histograms(X_binned, gradients):
+    n_samples, n_features = X_binned.shape
+    flat_bins = (X_binned + np.arange(n_features) * N_BINS).ravel()
+    grad_hist = np.bincount(flat_bins, weights=np.repeat(gradients, n_features),
+                            minlength=n_features * N_BINS)
+    count_hist = np.bincount(flat_bins, minlength=n_features * N_BINS)
+    return (grad_hist.reshape(n_features, N_BINS),
+            count_hist.reshape(n_features, N_BINS))
+
+def find_best_split(grad_hist, count_hist, min_samples_leaf,
+                    l2_regularization):
+    grad_total, count_total = grad_hist[0].sum(), count_hist[0].sum()
+    grad_left = grad_hist.cumsum(axis=1)[:, :-1]
+    count_left = count_hist.cumsum(axis=1)[:, :-1]
+    grad_right = grad_total - grad_left
+    count_right = count_total - count_left
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gains = (grad_left ** 2 / (count_left + l2_regularization)
+                 + grad_right ** 2 / (count_right + l2_regularization)
+                 - grad_total ** 2 / (count_total + l2_regularization))
+    too_small = ((count_left < min_samples_leaf)
+                 | (count_right < min_samples_leaf))
+    gains[too_small] = -np.inf
+    feature_idx, bin_idx = np.unravel_index(gains.argmax(), gains.shape)
+    return gains[feature_idx, bin_idx], feature_idx, bin_idx
+
+
+# Trees are grown leaf-wise (best first, like `HistGradientBoostingRegressor`): the leaf with the largest gain is split first, until we reach `max_leaf_nodes`. The tree is stored as a few arrays, and its leaves point back to themselves so that it can be traversed with vectorized NumPy operations, like the compiled forest of chapter 6's extra material. The `grow_tree()` function also returns the leaf of each training instance, which we will use to update the training predictions without calling `predict()`:
+
+# In[75]:
+
+
+import heapq
+from collections import namedtuple
+
+BinnedTree = namedtuple("BinnedTree", ["feature", "bin_threshold", "left",
+                                       "right", "value", "max_depth"])
+
+def grow_tree(X_binned, gradients, learning_rate=0.1, max_leaf_nodes=31,
+              min_samples_leaf=20, l2_regularization=0.0):
+    feature, bin_threshold, left, right, depth = [0], [0], [0], [0], [0]
+    leaf_of_sample = np.zeros(len(X_binned), dtype=np.int32)
+    candidates = []  # heap of (-gain, node_id, split_feature, split_bin, ...)
+
+    def push_candidate(node_id, indices, grad_hist, count_hist):
+        gain, split_feature, split_bin = find_best_split(
+            grad_hist, count_hist, min_samples_leaf, l2_regularization)
+        if gain > 0:
+            heapq.heappush(candidates, (-gain, node_id, split_feature,
+                                        split_bin, indices, grad_hist,
+                                        count_hist))
+
+    root_indices = np.arange(len(X_binned))
+    push_candidate(0, root_indices, *compute_histograms(X_binned, gradients))
+    n_leaves = 1
+    while candidates and n_leaves < max_leaf_nodes:
+        (_, node_id, split_feature, split_bin, indices, grad_hist,
+         count_hist) = heapq.heappop(candidates)
+        goes_left = X_binned[indices, split_feature] <= split_bin
+        children = []
+        for child_indices in (indices[goes_left], indices[~goes_left]):
+            child_id = len(feature)
+            feature.append(0)
+            bin_threshold.append(0)
+            left.append(child_id)
+            right.append(child_id)
+            depth.append(depth[node_id] + 1)
+            leaf_of_sample[child_indices] = child_id
+            children.append((child_id, child_indices))
+        feature[node_id], bin_threshold[node_id] = split_feature, split_bin
+        left[node_id], right[node_id] = children[0][0], children[1][0]
+        n_leaves += 1
+
+        # subtraction trick: only compute the smallest child's histograms
+        children.sort(key=lambda child: len(child[1]))
+        (small_id, small_indices), (large_id, large_indices) = children
+        small_hists = compute_histograms(X_binned[small_indices],
+                                         gradients[small_indices])
+        large_hists = (grad_hist - small_hists[0], count_hist - small_hists[1])
+        push_candidate(small_id, small_indices, *small_hists)
+        push_candidate(large_id, large_indices, *large_hists)
+
+    # leaf values: -learning_rate × sum of gradients / (n_samples + λ)
+    grad_sums = np.bincount(leaf_of_sample, weights=gradients,
+                            minlength=len(feature))
+    counts = np.bincount(leaf_of_sample, minlength=len(feature))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        value = -learning_rate * grad_sums / (counts + l2_regularization)
+    tree = BinnedTree(feature=np.array(feature, dtype=np.int32),
+                      bin_threshold=np.array(bin_threshold, dtype=np.uint8),
+                      left=np.array(left, dtype=np.int32),
+                      right=np.array(right, dtype=np.int32),
+                      value=np.nan_to_num(value), max_depth=max(depth))
+    return tree, leaf_of_sample
+
+def predict_binned(tree, X_binned):
+    rows = np.arange(len(X_binned))
+    nodes = np.zeros(len(X_binned), dtype=np.int32)
+    for _ in range(tree.max_depth):
+        goes_left = X_binned[rows, tree.feature[nodes]] <= tree.bin_threshold[nodes]
+        nodes = np.where(goes_left, tree.left[nodes], tree.right[nodes])
+    return tree.value[nodes]
+
+
+# Now let's put everything together in a Scikit-Learn compatible regressor:
+
+# In[76]:
+
+
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.metrics import mean_squared_error
+
+class HistGradientBoostingFromScratch(BaseEstimator, RegressorMixin):
+    def __init__(self, learning_rate=0.1, max_iter=100, max_leaf_nodes=31,
+                 min_samples_leaf=20, l2_regularization=0.0, max_bins=255,
+                 validation_fraction=0.1, n_iter_no_change=10, tol=1e-7,
+                 random_state=None):
+        self.learning_rate = learning_rate
+        self.max_iter = max_iter
+        self.max_leaf_nodes = max_leaf_nodes
+        self.min_samples_leaf = min_samples_leaf
+        self.l2_regularization = l2_regularization
+        self.max_bins = max_bins
+        self.validation_fraction = validation_fraction
+        self.n_iter_no_change = n_iter_no_change
+        self.tol = tol
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        X_train, X_valid, y_train, y_valid = train_test_split(
+            X, y, test_size=self.validation_fraction,
+            random_state=self.random_state)
+        self.bin_edges_ = compute_bin_edges(X_train, self.max_bins,
+                                            random_state=self.random_state)
+        X_train_binned = bin_features(X_train, self.bin_edges_)
+        X_valid_binned = bin_features(X_valid, self.bin_edges_)
+        self.baseline_prediction_ = y_train.mean()
+        y_train_pred = np.full(len(X_train), self.baseline_prediction_)
+        y_valid_pred = np.full(len(X_valid), self.baseline_prediction_)
+        self.trees_, self.validation_scores_ = [], []
+        best_score, best_n_trees = np.inf, 0
+        for iteration in range(self.max_iter):
+            gradients = y_train_pred - y_train
+            tree, leaf_of_sample = grow_tree(
+                X_train_binned, gradients, self.learning_rate,
+                self.max_leaf_nodes, self.min_samples_leaf,
+                self.l2_regularization)
+            self.trees_.append(tree)
+            y_train_pred += tree.value[leaf_of_sample]
+            y_valid_pred += predict_binned(tree, X_valid_binned)
+            score = mean_squared_error(y_valid, y_valid_pred) ** 0.5
+            self.validation_scores_.append(score)
+            if score < best_score - self.tol:
+                best_score, best_n_trees = score, iteration + 1
+            elif iteration + 1 - best_n_trees >= self.n_iter_no_change:
+                break
+        self.trees_ = self.trees_[:best_n_trees]
+        self.n_iter_ = best_n_trees
+        return self
+
+    def staged_predict(self, X):
+        X_binned = bin_features(np.asarray(X, dtype=np.float64),
+                                self.bin_edges_)
+        y_pred = np.full(len(X_binned), self.baseline_prediction_)
+        for tree in self.trees_:
+            y_pred += predict_binned(tree, X_binned)
+            yield y_pred.copy()
+
+    def predict(self, X):
+        X_binned = bin_features(np.asarray(X, dtype=np.float64),
+                                self.bin_edges_)
+        y_pred = np.full(len(X_binned), self.baseline_prediction_)
+        for tree in self.trees_:
+            y_pred += predict_binned(tree, X_binned)
+        return y_pred
+
+
+# Let's train it on the quadratic dataset we used earlier. Since this dataset only has 100 instances, we need to reduce `min_samples_leaf`:
+
+# In[77]:
+
+
+hgb_scratch = HistGradientBoostingFromScratch(
+    learning_rate=0.05, max_iter=500, max_leaf_nodes=4, min_samples_leaf=2,
+    random_state=42)
+hgb_scratch.fit(X, y)
+hgb_scratch.n_iter_
+
+
+# In[78]:
+
+
+plot_predictions([hgb_scratch], X, y, axes=[-0.5, 0.5, -0.1, 0.8], style="r-",
+                 label="Ensemble predictions")
+plt.xlabel("$x_1$")
+plt.ylabel("$y$", rotation=0)
+plt.show()
+
+
+# Now let's benchmark it against `GradientBoostingRegressor` and `HistGradientBoostingRegressor` on the California housing dataset, using the same preprocessing as `hgb_reg` earlier (but treating the ocean proximity as a regular numerical feature, since our implementation does not support categorical features). All three models use early stopping:
+
+# In[79]:
+
+
+import time
+from sklearn.impute import SimpleImputer
+
+housing_test = test_set.drop("median_house_value", axis=1)
+housing_test_labels = test_set["median_house_value"]
+
+boosting_regressors = {
+    "GradientBoostingRegressor": GradientBoostingRegressor(
+        max_leaf_nodes=31, n_estimators=500, n_iter_no_change=10,
+        random_state=42),
+    "HistGradientBoostingRegressor": HistGradientBoostingRegressor(
+        max_iter=500, early_stopping=True, random_state=42),
+    "HistGradientBoostingFromScratch": HistGradientBoostingFromScratch(
+        max_iter=500, random_state=42),
+}
+for name, regressor in boosting_regressors.items():
+    pipeline = make_pipeline(
+        make_column_transformer((OrdinalEncoder(), ["ocean_proximity"]),
+                                remainder="passthrough"),
+        regressor)
+    if name == "GradientBoostingRegressor":  # it does not support NaNs
+        pipeline.steps.insert(1, ("simpleimputer",
+                                  SimpleImputer(strategy="median")))
+    start = time.perf_counter()
+    pipeline.fit(housing, housing_labels)
+    fit_time = time.perf_counter() - start
+    rmse = mean_squared_error(housing_test_labels,
+                              pipeline.predict(housing_test)) ** 0.5
+    n_trees = getattr(regressor, "n_estimators_", None) or regressor.n_iter_
+    print(f"{name}: {fit_time:.1f}s, {n_trees} trees, test RMSE: {rmse:,.0f}")
+
+
+# Our implementation is much faster than `GradientBoostingRegressor` and reaches a similar RMSE, but the highly optimized Cython code of `HistGradientBoostingRegressor` is still faster. Lastly, let's look at the learning curve computed during training:
+
+# In[80]:
+
+
+hgb_scratch = boosting_regressors["HistGradientBoostingFromScratch"]
+plt.plot(np.arange(1, len(hgb_scratch.validation_scores_) + 1),
+         hgb_scratch.validation_scores_, "b-")
+plt.axvline(hgb_scratch.n_iter_, color="k", linestyle="--",
+            label="Best iteration")
+plt.xlabel("Number of trees")
+plt.ylabel("Validation RMSE")
+plt.legend()
+plt.grid()
+plt.show()
+
+
+# # Extra Material – Building the Blender's Training Set Efficiently
+
+# In exercise 9, we trained the base classifiers one after the other, and `StackingClassifier` then trained them all again (5 times each, plus once on the full training set). Moreover, if we want to try another blender, `StackingClassifier` retrains everything. Instead, we can build the blender's training set ourselves, once:
+# 
+# * All the (base estimator, fold) pairs are independent, so we can train them in parallel. Joblib automatically memory-maps large NumPy arrays such as MNIST, so all the worker processes share the same copy of the data, and each task only receives the indices of its training instances and of its held-out instances.
+# * Each base estimator makes _out-of-fold_ predictions: every training instance is predicted by a model that was not trained on it, just like in `StackingClassifier`. Each base estimator is also trained on the full training set to make predictions on the test set.
+# * Like `StackingClassifier`, we use `predict_proba()` if available, or else `decision_function()`, or else `predict()`.
+# * The predictions of each base estimator are saved to disk, under a key computed from the estimator's class and hyperparameters, the cross-validation settings, and a fingerprint of the data. So if we change the blender, or add a new base estimator, the other base estimators are not retrained.
+
+# In[81]:
+
+
+from joblib import Parallel, delayed
+from joblib import hash as joblib_hash
+from sklearn.base import clone
+from sklearn.model_selection import StratifiedKFold
+
+def stacking_method(estimator):
+    for method in ("predict_proba", "decision_function", "predict"):
+        if hasattr(estimator, method):
+            return method
+
+def fit_and_predict(estimator, X, y, train_indices, X_pred, pred_indices):
+    estimator.fit(X[train_indices], y[train_indices])
+    y_pred = getattr(estimator, stacking_method(estimator))(X_pred[pred_indices])
+    return y_pred.reshape(len(y_pred), -1)
+
+def build_blender_dataset(estimators, X_train, y_train, X_test, cv=5,
+                          random_state=42, n_jobs=-1,
+                          cache_dir=Path("my_blender_cache")):
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    data_fingerprint = joblib_hash((X_train, y_train, X_test, cv, random_state))
+    cache_paths = [
+        cache_dir / "{}_{}.npz".format(
+            type(estimator).__name__,
+            joblib_hash((type(estimator), estimator.get_params(),
+                         data_fingerprint)))
+        for estimator in estimators]
+    missing = [index for index, path in enumerate(cache_paths)
+               if not path.is_file()]
+
+    folds = list(StratifiedKFold(cv, shuffle=True, random_state=random_state)
+                 .split(X_train, y_train))
+    all_indices = np.arange(len(X_train))
+    test_indices = np.arange(len(X_test))
+    tasks = [(index, fold_index, train_indices, X_train, valid_indices)
+             for index in missing
+             for fold_index, (train_indices, valid_indices) in enumerate(folds)]
+    tasks += [(index, None, all_indices, X_test, test_indices)
+              for index in missing]
+    predictions = Parallel(n_jobs=n_jobs)(
+        delayed(fit_and_predict)(clone(estimators[index]), X_train, y_train,
+                                 train_indices, X_pred, pred_indices)
+        for index, _, train_indices, X_pred, pred_indices in tasks)
+
+    for index in missing:
+        task_predictions = [(fold_index, y_pred)
+                            for (task_index, fold_index, *_), y_pred
+                            in zip(tasks, predictions) if task_index == index]
+        y_test_pred = next(y_pred for fold_index, y_pred in task_predictions
+                           if fold_index is None)
+        y_oof_pred = np.empty((len(X_train), y_test_pred.shape[1]),
+                              dtype=y_test_pred.dtype)
+        for fold_index, y_pred in task_predictions:
+            if fold_index is not None:
+                y_oof_pred[folds[fold_index][1]] = y_pred
+        np.savez(cache_paths[index], oof=y_oof_pred, test=y_test_pred)
+
+    cached = [np.load(path) for path in cache_paths]
+    return (np.hstack([predictions["oof"] for predictions in cached]),
+            np.hstack([predictions["test"] for predictions in cached]))
+
+
+# Let's use it to build the blender's training set on the full training set. The first run trains the 4 base classifiers 6 times each (in parallel, so the total time depends on the number of cores), just like `StackingClassifier`:
+
+# **Warning**: just like the `StackingClassifier` above, the following cell can take a while to run the first time.
+
+# In[82]:
+
+
+base_estimators = [estimator for name, estimator in named_estimators]
+X_train_blend, X_test_blend = build_blender_dataset(
+    base_estimators, X_train_full, y_train_full, X_test)
+X_train_blend.shape
+
+
+# Now we can train and compare several blenders, without retraining any base classifier:
+
+# In[83]:
+
+
+blenders = [
+    RandomForestClassifier(n_estimators=200, random_state=42),
+    LogisticRegression(max_iter=1000, random_state=42),
+]
+for blender in blenders:
+    blender.fit(X_train_blend, y_train_full)
+    print(type(blender).__name__, blender.score(X_test_blend, y_test))
+
+
+# If we call `build_blender_dataset()` again with the same base estimators, their predictions are just loaded from the cache (and if we add a new base estimator, only this one gets trained):
+
+# In[84]:
+
+
+get_ipython().run_line_magic('time', 'X_train_blend, X_test_blend = build_blender_dataset(base_estimators, X_train_full, y_train_full, X_test)')
+
+
+# # Extra Material – Voting Within a Latency Budget
+
+# In exercise 8, we removed the SVM from the voting classifier by hand because it hurt performance. When serving a large ensemble, there is another reason to drop some members: each of them adds to the prediction latency. Let's build a voting classifier that profiles its (already trained) members on the validation set, measuring the 99th percentile (p99) of each member's prediction latency for a batch of a given size, as well as its contribution to the ensemble's validation accuracy. A member's contribution is the drop in validation accuracy when it is removed from the ensemble. Starting from all the members, it repeatedly removes the member with the lowest contribution per second of latency, as long as the sum of the remaining members' p99 latencies exceeds the latency budget per batch (this is a conservative estimate, since the members actually run concurrently). Then it keeps removing members whose contribution is negative, i.e., members that hurt the ensemble. Then, at prediction time:
+# 
+# * The selected members run concurrently in a thread pool (most of the heavy lifting in Scikit-Learn and NumPy releases the GIL), and they are submitted in decreasing order of accuracy contribution per second of latency, so the most useful members start first if the pool has fewer threads than members.
+# * With hard voting, we count the votes as the predictions come in, and as soon as the winning class of every instance in the batch can no longer change (i.e., its lead over the runner-up exceeds the number of pending votes), we stop waiting and cancel the members that have not started yet. The result is identical to waiting for all the votes. Note that a member that is already running cannot be interrupted: it finishes in the background, and its output is ignored.
+# * The thread pool is created by `fit()`, and it is shut down when we call `close()` (or when the classifier is garbage collected).
+
+# In[85]:
+
+
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+class LatencyBudgetedVotingClassifier:
+    def __init__(self, estimators, latency_budget, voting="hard",
+                 batch_size=100, n_repeats=20, n_threads=None):
+        self.estimators = estimators  # list of (name, trained estimator)
+        self.latency_budget = latency_budget  # in seconds per batch
+        self.voting = voting
+        self.batch_size = batch_size
+        self.n_repeats = n_repeats
+        self.n_threads = n_threads
+
+    def _member_output(self, estimator, X):
+        if self.voting == "soft":
+            return estimator.predict_proba(X)
+        return np.searchsorted(self.classes_, estimator.predict(X))
+
+    def _vote(self, outputs):
+        if self.voting == "soft":
+            return np.mean(outputs, axis=0).argmax(axis=1)
+        votes = np.zeros((len(outputs[0]), len(self.classes_)), dtype=np.int32)
+        for class_indices in outputs:
+            votes[np.arange(len(class_indices)), class_indices] += 1
+        return votes.argmax(axis=1)
+
+    def _p99_latency(self, estimator, X_batch):
+        latencies = []
+        for _ in range(self.n_repeats):
+            start = time.perf_counter()
+            self._member_output(estimator, X_batch)
+            latencies.append(time.perf_counter() - start)
+        return np.percentile(latencies, 99)
+
+    def fit(self, X_valid, y_valid):
+        self.classes_ = self.estimators[0][1].classes_
+        y_valid = np.searchsorted(self.classes_, y_valid)
+        X_batch = X_valid[:self.batch_size]
+        self.latencies_ = {name: self._p99_latency(estimator, X_batch)
+                           for name, estimator in self.estimators}
+        outputs = {name: self._member_output(estimator, X_valid)
+                   for name, estimator in self.estimators}
+
+        def subset_accuracy(names):
+            if not names:
+                return 0.0  # an empty ensemble gets no prediction right
+            y_pred = self._vote([outputs[name] for name in names])
+            return (y_pred == y_valid).mean()
+
+        selected = [name for name, estimator in self.estimators]
+        while True:
+            accuracy = subset_accuracy(selected)
+            self.contributions_ = {
+                name: accuracy - subset_accuracy([other for other in selected
+                                                  if other != name])
+                for name in selected}
+            if len(selected) == 1:
+                break
+            total_latency = sum(self.latencies_[name] for name in selected)
+            if total_latency > self.latency_budget:
+                worst_name = min(selected, key=lambda name: (
+                    self.contributions_[name] / self.latencies_[name]))
+            else:
+                worst_name = min(self.contributions_,
+                                 key=self.contributions_.get)
+                if self.contributions_[worst_name] >= 0:
+                    break
+            selected.remove(worst_name)
+
+        selected.sort(key=lambda name: (self.contributions_[name]
+                                        / self.latencies_[name]),
+                      reverse=True)
+        named_estimators = dict(self.estimators)
+        self.selected_estimators_ = [(name, named_estimators[name])
+                                     for name in selected]
+        self.validation_accuracy_ = accuracy
+        self.close()  # in case fit() was already called
+        self.executor_ = ThreadPoolExecutor(self.n_threads
+                                            or len(selected))
+        return self
+
+    def close(self):
+        executor = getattr(self, "executor_", None)
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.executor_ = None
+
+    def __del__(self):
+        self.close()
+
+    def predict(self, X):
+        futures = [self.executor_.submit(self._member_output, estimator, X)
+                   for name, estimator in self.selected_estimators_]
+        if self.voting == "soft":
+            return self.classes_[self._vote([future.result()
+                                             for future in futures])]
+        votes = np.zeros((len(X), len(self.classes_)), dtype=np.int32)
+        pending = len(futures)
+        for future in as_completed(futures):
+            votes[np.arange(len(X)), future.result()] += 1
+            pending -= 1
+            top_two = np.sort(votes, axis=1)[:, -2:]
+            if pending > 0 and (top_two[:, 1] - top_two[:, 0] > pending).all():
+                for other_future in futures:
+                    other_future.cancel()
+                break
+        return self.classes_[votes.argmax(axis=1)]
+
+    def score(self, X, y):
+        return (self.predict(X) == y).mean()
+
+
+# Let's first profile the ensemble without any real constraint, to see each member's p99 latency for a batch of 100 images on this machine:
+
+# In[86]:
+
+
+budgeted_voting_clf = LatencyBudgetedVotingClassifier(named_estimators,
+                                                      latency_budget=np.inf)
+budgeted_voting_clf.fit(X_valid, y_valid)
+budgeted_voting_clf.latencies_
+
+
+# Let's look at the selected members and their accuracy contributions. Members that hurt the ensemble were dropped, even without any latency constraint (in the exercise, that was the SVM):
+
+# In[87]:
+
+
+budgeted_voting_clf.contributions_
+
+
+# In[88]:
+
+
+budgeted_voting_clf.score(X_test, y_test)
+
+
+# Now let's set a budget of half the total p99 latency of all the members (on your hardware, the selected members may differ), and compare the p99 latency per batch on the test set:
+
+# In[89]:
+
+
+latency_budget = sum(budgeted_voting_clf.latencies_.values()) / 2
+fast_voting_clf = LatencyBudgetedVotingClassifier(
+    named_estimators, latency_budget=latency_budget)
+fast_voting_clf.fit(X_valid, y_valid)
+[name for name, estimator in fast_voting_clf.selected_estimators_]
+
+
+# In[90]:
+
+
+def p99_batch_latency(clf, X, batch_size=100):
+    latencies = []
+    for start in range(0, len(X), batch_size):
+        start_time = time.perf_counter()
+        clf.predict(X[start:start + batch_size])
+        latencies.append(time.perf_counter() - start_time)
+    return np.percentile(latencies, 99)
+
+for clf in (budgeted_voting_clf, fast_voting_clf):
+    print(f"p99 latency: {p99_batch_latency(clf, X_test) * 1000:.1f} ms, "
+          f"test accuracy: {clf.score(X_test, y_test):.4f}")
+
+
+# We're done with these classifiers, so let's shut down their thread pools:
+
+# In[91]:
+
+
+for clf in (budgeted_voting_clf, fast_voting_clf):
+    clf.close()
+
+
 # And that's all for today, congratulations on finishing the chapter and the exercises!
 
 # In[ ]:
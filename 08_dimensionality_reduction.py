@@ -1060,16 +1060,38 @@ plt.show()
 # In[69]:
 
 
+from math import sqrt
+
 from sklearn.preprocessing import MinMaxScaler
 from matplotlib.offsetbox import AnnotationBbox, OffsetImage
 
+def select_spread_points(X, min_distance):
+    # We keep each point only if no point kept so far lies within
+    # `min_distance`. To avoid comparing it with all the points kept so far,
+    # we hash the kept points into a grid of square cells of size
+    # `min_distance`: any close neighbor must then be in one of the 9 cells
+    # around the point's cell.
+    grid = {}
+    points = X.tolist()  # Python floats are faster to handle one by one
+    selected = np.empty(len(X), dtype=np.intp)  # preallocated buffer
+    n_selected = 0
+    for index, (x1, x2) in enumerate(points):
+        cell_x1, cell_x2 = int(x1 // min_distance), int(x2 // min_distance)
+        # any() stops scanning as soon as it finds a close neighbor
+        is_close = any(
+            sqrt((x1 - points[other][0]) ** 2 + (x2 - points[other][1]) ** 2)
+            <= min_distance
+            for dx1 in (-1, 0, 1) for dx2 in (-1, 0, 1)
+            for other in grid.get((cell_x1 + dx1, cell_x2 + dx2), ()))
+        if not is_close:
+            grid.setdefault((cell_x1, cell_x2), []).append(index)
+            selected[n_selected] = index
+            n_selected += 1
+    return selected[:n_selected]
+
 def plot_digits(X, y, min_distance=0.04, images=None, figsize=(13, 10)):
     # Let's scale the input features so that they range from 0 to 1
     X_normalized = MinMaxScaler().fit_transform(X)
-    # Now we create the list of coordinates of the digits plotted so far.
-    # We pretend that one is already plotted far away at the start, to
-    # avoid `if` statements in the loop below
-    neighbors = np.array([[10., 10.]])
     # The rest should be self-explanatory
     plt.figure(figsize=figsize)
     cmap = plt.cm.jet
@@ -1079,19 +1101,17 @@ def plot_digits(X, y, min_distance=0.04, images=None, figsize=(13, 10)):
                     c=[cmap(float(digit) / 9)], alpha=0.5)
     plt.axis("off")
     ax = plt.gca()  # get current axes
-    for index, image_coord in enumerate(X_normalized):
-        closest_distance = np.linalg.norm(neighbors - image_coord, axis=1).min()
-        if closest_distance > min_distance:
-            neighbors = np.r_[neighbors, [image_coord]]
-            if images is None:
-                plt.text(image_coord[0], image_coord[1], str(int(y[index])),
-                         color=cmap(float(y[index]) / 9),
-                         fontdict={"weight": "bold", "size": 16})
-            else:
-                image = images[index].reshape(28, 28)
-                imagebox = AnnotationBbox(OffsetImage(image, cmap="binary"),
-                                          image_coord)
-                ax.add_artist(imagebox)
+    for index in select_spread_points(X_normalized, min_distance):
+        image_coord = X_normalized[index]
+        if images is None:
+            plt.text(image_coord[0], image_coord[1], str(int(y[index])),
+                     color=cmap(float(y[index]) / 9),
+                     fontdict={"weight": "bold", "size": 16})
+        else:
+            image = images[index].reshape(28, 28)
+            imagebox = AnnotationBbox(OffsetImage(image, cmap="binary"),
+                                      image_coord)
+            ax.add_artist(imagebox)
 
 
 # Let's try it! First let's show colored digits (not images), for all 5,000 images:
@@ -1205,6 +1225,511 @@ plt.show()
 
 # Well, it's pretty clear that t-SNE won this little competition, wouldn't you agree?
 
+# # Extra Material – Out-of-Core PCA with Prefetching
+
+# Earlier in this chapter, we trained an `IncrementalPCA` on a `memmap`. Every batch is read from disk, then folded into the model, then the next batch is read, and so on: the disk sits idle while the SVD is computed, and vice versa. Instead, we can read the next batch in a background thread while the current one is being processed. If reading fails (e.g., the file is truncated), the reader thread passes the exception through the queue, and it is raised in the main thread, rather than leaving the main thread waiting forever for the next batch. Conversely, if the main thread stops consuming the batches early (e.g., because of a `break` or an exception), the generator is closed, and it tells the reader thread to stop, so the thread doesn't stay blocked forever, holding on to the data. This works well because NumPy releases the GIL while copying large arrays, and so does the SVD. For a dataset much larger than RAM, the total time approaches the max of the I/O time and the computation time, rather than their sum.
+# 
+# We also pick the batch size based on a memory budget: we need room for the batch being processed, plus the prefetched batches, plus the working copies made by `partial_fit()` (it stacks the batch with the current components and computes their SVD). To be on the safe side, we assume 64-bit floats everywhere.
+
+# In[79]:
+
+
+import queue
+import threading
+
+def batch_size_for_memory_budget(n_features, n_components, memory_budget,
+                                 prefetch=2, n_working_copies=3):
+    bytes_per_row = n_features * np.dtype(np.float64).itemsize
+    batch_size = memory_budget // (bytes_per_row * (prefetch + n_working_copies))
+    return max(int(batch_size), n_components)
+
+def prefetch_batches(X, batch_size, prefetch=2):
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):  # gives up if the consumer has stopped
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_batches():
+        try:
+            for start in range(0, len(X), batch_size):
+                # np.array() forces the batch to actually be read from disk
+                if not put(np.array(X[start:start + batch_size])):
+                    return
+        except Exception as exception:
+            put(exception)  # it will be raised by the main thread
+        else:
+            put(None)
+
+    reader = threading.Thread(target=read_batches, daemon=True)
+    reader.start()
+    try:
+        while (X_batch := batches.get()) is not None:
+            if isinstance(X_batch, Exception):
+                raise X_batch
+            yield X_batch
+    finally:  # e.g., the consumer broke out of the loop or raised an exception
+        stop.set()
+        reader.join()
+
+
+# The first pass fits the `IncrementalPCA`. Note that every batch passed to `partial_fit()` must contain at least `n_components` instances, so if the last batch is too small, we merge it with the previous one:
+
+# In[80]:
+
+
+def streaming_pca_fit(X, n_components, memory_budget=500 * 2**20, prefetch=2):
+    batch_size = batch_size_for_memory_budget(X.shape[1], n_components,
+                                              memory_budget, prefetch)
+    inc_pca = IncrementalPCA(n_components=n_components)
+    previous_batch = None
+    for X_batch in prefetch_batches(X, batch_size, prefetch):
+        if previous_batch is not None:
+            if len(X_batch) < n_components:
+                X_batch = np.r_[previous_batch, X_batch]
+            else:
+                inc_pca.partial_fit(previous_batch)
+        previous_batch = X_batch
+    inc_pca.partial_fit(previous_batch)
+    return inc_pca
+
+
+# The second pass projects the data, batch by batch, and writes the result straight to an output `memmap`, so the reduced dataset never needs to fit in RAM either:
+
+# In[81]:
+
+
+def streaming_pca_transform(inc_pca, X, output_filename,
+                            memory_budget=500 * 2**20, prefetch=2):
+    batch_size = batch_size_for_memory_budget(
+        X.shape[1], inc_pca.n_components_, memory_budget, prefetch)
+    X_reduced = np.memmap(output_filename, dtype="float32", mode="write",
+                          shape=(len(X), inc_pca.n_components_))
+    start = 0
+    for X_batch in prefetch_batches(X, batch_size, prefetch):
+        X_reduced[start:start + len(X_batch)] = inc_pca.transform(X_batch)
+        start += len(X_batch)
+    X_reduced.flush()
+    return X_reduced
+
+
+# Let's try it on the MNIST `memmap` we created earlier, with a memory budget of 50 MB:
+
+# In[82]:
+
+
+X_mmap = np.memmap(filename, dtype="float32", mode="readonly").reshape(-1, 784)
+memory_budget = 50 * 2**20
+inc_pca = streaming_pca_fit(X_mmap, n_components=154,
+                            memory_budget=memory_budget)
+X_reduced_mmap = streaming_pca_transform(inc_pca, X_mmap, "my_mnist_pca.mmap",
+                                         memory_budget=memory_budget)
+X_reduced_mmap.shape
+
+
+# Let's check that we get the same components as by feeding the same batches synchronously:
+
+# In[83]:
+
+
+batch_size = batch_size_for_memory_budget(784, 154, memory_budget)
+sync_inc_pca = IncrementalPCA(n_components=154, batch_size=batch_size)
+sync_inc_pca.fit(X_mmap)
+np.allclose(inc_pca.components_, sync_inc_pca.components_)
+
+
+# Now let's compare the fitting times. MNIST is small enough to sit in the OS cache, so the I/O is nearly free here and the difference is small: the benefits show up on datasets that are much larger than RAM, on slow disks, or when each batch must be decompressed or preprocessed in Python:
+
+# In[84]:
+
+
+get_ipython().run_line_magic('timeit', '-n 1 -r 3 IncrementalPCA(n_components=154, batch_size=batch_size).fit(X_mmap)')
+get_ipython().run_line_magic('timeit', '-n 1 -r 3 streaming_pca_fit(X_mmap, n_components=154, memory_budget=memory_budget)')
+
+
+# # Extra Material – Choosing a PCA Solver
+
+# In this chapter we used `PCA` with the full SVD, randomized PCA, `IncrementalPCA`, and random projections. Which one is the fastest depends on the number of instances _m_, the number of features _n_ and the target number of dimensions _d_, but also on your hardware. So let's measure it! For each solver and each shape, we record the wall time, the peak memory allocated during training (measured using Python's `tracemalloc` module, which NumPy reports its allocations to, in a separate run since tracing slows down allocations), and the fraction of the variance captured by the top _d_ principal components that the solver misses (we call this the explained variance error). For random projections, we measure the variance captured by the random subspace:
+
+# In[85]:
+
+
+import json
+import time
+import tracemalloc
+
+import pandas as pd
+
+PCA_SOLVERS = ["full", "randomized", "incremental", "random_projection"]
+
+def make_pca_reducer(solver, n_components, random_state=42):
+    if solver == "incremental":
+        return IncrementalPCA(n_components=n_components)
+    if solver == "random_projection":
+        return GaussianRandomProjection(n_components=n_components,
+                                        random_state=random_state)
+    return PCA(n_components=n_components, svd_solver=solver,
+               random_state=random_state)
+
+def captured_variance(X_centered, components):
+    Q, _ = np.linalg.qr(components.T)  # orthonormal basis of the subspace
+    return np.square(X_centered @ Q).sum()
+
+def benchmark_pca_solver(solver, X, n_components):
+    reducer = make_pca_reducer(solver, n_components)
+    start = time.perf_counter()
+    reducer.fit(X)
+    wall_time = time.perf_counter() - start
+    # tracing slows down allocations, so we measure memory in a separate run
+    tracemalloc.start()
+    make_pca_reducer(solver, n_components).fit(X)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return reducer, wall_time, peak_memory
+
+def generate_low_rank_data(n_samples, n_features, rank=50, noise=0.1, seed=42):
+    rng = np.random.default_rng(seed)
+    scales = 1 / np.arange(1, rank + 1)  # decreasing singular values
+    X = (rng.standard_normal((n_samples, rank)) * scales
+         @ rng.standard_normal((rank, n_features)))
+    return X + noise * rng.standard_normal((n_samples, n_features))
+
+def benchmark_pca_solvers(sample_sizes, feature_sizes, component_sizes):
+    results = []
+    for n_samples in sample_sizes:
+        for n_features in feature_sizes:
+            X = generate_low_rank_data(n_samples, n_features)
+            X_centered = X - X.mean(axis=0)
+            for n_components in component_sizes:
+                if n_components > min(n_samples, n_features):
+                    continue
+                for solver in PCA_SOLVERS:
+                    reducer, wall_time, peak_memory = benchmark_pca_solver(
+                        solver, X, n_components)
+                    variance = captured_variance(X_centered,
+                                                 reducer.components_)
+                    if solver == "full":  # this is the exact reference
+                        best_variance = variance
+                    results.append({
+                        "solver": solver, "n_samples": n_samples,
+                        "n_features": n_features, "n_components": n_components,
+                        "wall_time": wall_time, "peak_memory": peak_memory,
+                        "variance_error": 1 - variance / best_variance})
+    return pd.DataFrame(results)
+
+
+# **Warning**: the following cell takes a few minutes to run:
+
+# In[86]:
+
+
+pca_benchmark = benchmark_pca_solvers(sample_sizes=[1_000, 5_000, 20_000],
+                                      feature_sizes=[100, 300, 1_000],
+                                      component_sizes=[10, 50, 150])
+pca_benchmark.to_csv("my_pca_benchmark.csv", index=False)
+pca_benchmark.groupby("solver")[["wall_time", "peak_memory",
+                                 "variance_error"]].mean()
+
+
+# Now let's build a simple cost model from these measurements: for each solver, we fit a linear regression of log(time) and log(peak memory) against log(_m_), log(_n_) and log(_d_) (i.e., we assume the costs are proportional to _m_<sup>α</sup>_n_<sup>β</sup>_d_<sup>γ</sup>). We also keep the worst explained variance error observed for each solver. The model is saved to a small JSON file, so you can ship it along with your code for a given kind of hardware:
+
+# In[87]:
+
+
+def log_shape_features(n_samples, n_features, n_components):
+    return np.log(np.c_[n_samples, n_features, n_components]
+                  .astype(np.float64))
+
+def build_pca_cost_model(benchmark):
+    cost_model = {}
+    for solver, results in benchmark.groupby("solver"):
+        X_log = np.c_[np.ones(len(results)), log_shape_features(
+            results["n_samples"], results["n_features"],
+            results["n_components"])]
+        time_coefs = np.linalg.lstsq(X_log, np.log(results["wall_time"]),
+                                     rcond=None)[0]
+        memory_coefs = np.linalg.lstsq(X_log,
+                                       np.log(results["peak_memory"] + 1),
+                                       rcond=None)[0]
+        cost_model[solver] = {
+            "time_coefs": time_coefs.tolist(),
+            "memory_coefs": memory_coefs.tolist(),
+            "max_variance_error": results["variance_error"].max()}
+    return cost_model
+
+pca_cost_model = build_pca_cost_model(pca_benchmark)
+Path("my_pca_cost_model.json").write_text(json.dumps(pca_cost_model, indent=2))
+pca_cost_model["randomized"]
+
+
+# Lastly, the `auto` selector picks the fastest solver whose predicted peak memory fits in the memory budget, and whose explained variance error is acceptable. If none fits, it falls back to `IncrementalPCA`, whose memory usage does not depend on the number of instances:
+
+# In[88]:
+
+
+def select_pca_solver(n_samples, n_features, n_components, memory_budget,
+                      max_variance_error=0.01, cost_model=None):
+    if cost_model is None:
+        cost_model = json.loads(Path("my_pca_cost_model.json").read_text())
+    x_log = np.r_[1, log_shape_features(n_samples, n_features,
+                                        n_components)[0]]
+    predicted_times = {}
+    for solver, model in cost_model.items():
+        predicted_memory = np.exp(x_log @ model["memory_coefs"])
+        if (model["max_variance_error"] <= max_variance_error
+                and predicted_memory <= memory_budget):
+            predicted_times[solver] = np.exp(x_log @ model["time_coefs"])
+    if not predicted_times:
+        return "incremental"
+    return min(predicted_times, key=predicted_times.get)
+
+
+# Let's see which solver it picks for MNIST with 154 components, depending on the memory budget and the required precision:
+
+# In[89]:
+
+
+for memory_budget in (2**30, 50 * 2**20):
+    for max_variance_error in (0.01, 1.0):
+        solver = select_pca_solver(60_000, 784, 154, memory_budget,
+                                   max_variance_error)
+        print(f"memory_budget={memory_budget / 2**20:.0f}MB, "
+              f"max_variance_error={max_variance_error}: {solver}")
+
+
+# In[90]:
+
+
+solver = select_pca_solver(60_000, 784, 154, memory_budget=2**30)
+get_ipython().run_line_magic('time', 'make_pca_reducer(solver, 154).fit(X_train)')
+
+
+# # Extra Material – Thinning Large Embeddings
+
+# The first version of `plot_digits()` compared each candidate point with all the points kept so far, using `np.linalg.norm()`, and it grew the array of kept points with `np.r_` at each step: that's quadratic in time and memory allocations, which is fine for 5,000 points but takes minutes for a t-SNE embedding of the 70,000 MNIST images. The `select_spread_points()` function only compares each point with the points kept in the 9 grid cells around it. Let's check that it selects exactly the same points as the original approach:
+
+# In[91]:
+
+
+def select_spread_points_naive(X, min_distance):
+    neighbors = np.array([[10., 10.]])
+    selected = []
+    for index, image_coord in enumerate(X):
+        closest_distance = np.linalg.norm(neighbors - image_coord, axis=1).min()
+        if closest_distance > min_distance:
+            neighbors = np.r_[neighbors, [image_coord]]
+            selected.append(index)
+    return np.array(selected)
+
+X_normalized = MinMaxScaler().fit_transform(X_reduced)
+np.array_equal(select_spread_points(X_normalized, min_distance=0.04),
+               select_spread_points_naive(X_normalized, min_distance=0.04))
+
+
+# Now let's compare their speed on 70,000 random points, with a smaller minimum distance, so that many points get selected:
+
+# In[92]:
+
+
+X_many = np.random.default_rng(42).random((70_000, 2))
+get_ipython().run_line_magic('timeit', '-n 1 -r 1 select_spread_points_naive(X_many, min_distance=0.01)')
+get_ipython().run_line_magic('timeit', '-n 1 -r 1 select_spread_points(X_many, min_distance=0.01)')
+
+
+# # Extra Material – Sharing a Nearest Neighbors Graph Between Manifold Learners
+
+# Most manifold learning algorithms start by finding each instance's nearest neighbors, and on high-dimensional data such as MNIST this search is often the most expensive step. If you compare several algorithms, or sweep `n_neighbors`, every run repeats the same search. Instead, we can compute the _k_-nearest neighbors graph once, with the largest _k_ we need, using `KNeighborsTransformer` (which relies on a k-d tree or ball tree when possible), and save it to disk. Each row of this sparse graph contains the distances from one instance to its nearest neighbors, sorted by distance, so the graph for any smaller _k_ is obtained by just keeping the first _k_ entries of each row.
+
+# In[93]:
+
+
+from scipy import sparse
+from joblib import hash as joblib_hash
+from sklearn.neighbors import KNeighborsTransformer
+
+def build_knn_graph(X, n_neighbors, cache_dir=Path("my_knn_graphs")):
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    path = cache_dir / f"knn_{n_neighbors}_{joblib_hash(X)}.npz"
+    if path.is_file():
+        return sparse.load_npz(path)
+    knn_graph = KNeighborsTransformer(n_neighbors=n_neighbors,
+                                      mode="distance").fit_transform(X)
+    sparse.save_npz(path, knn_graph)
+    return knn_graph
+
+def restrict_knn_graph(knn_graph, n_neighbors):
+    # each row holds the instance itself, then its neighbors sorted by distance
+    n_samples, row_size = knn_graph.shape[0], n_neighbors + 1
+    indices = knn_graph.indices.reshape(n_samples, -1)[:, :row_size]
+    data = knn_graph.data.reshape(n_samples, -1)[:, :row_size]
+    indptr = np.arange(0, n_samples * row_size + 1, row_size)
+    return sparse.csr_matrix((data.ravel(), indices.ravel(), indptr),
+                             shape=knn_graph.shape)
+
+
+# The neighbors-based learners accept such a graph if we set `metric="precomputed"` (`Isomap`, `TSNE`) or `affinity="precomputed_nearest_neighbors"` (`SpectralEmbedding`, a.k.a. Laplacian Eigenmaps). Note that `LocallyLinearEmbedding` needs the neighbors' coordinates, not just their distances, so it cannot use this graph, and MDS is not neighbors-based: it uses all pairwise distances. t-SNE needs at least 3 × `perplexity` + 1 neighbors per instance, so let's build the graph with 91 neighbors for the 5,000 MNIST images we used in exercise 10:
+
+# In[94]:
+
+
+get_ipython().run_line_magic('time', 'knn_graph = build_knn_graph(X_sample, n_neighbors=91)')
+
+
+# Now we can sweep `n_neighbors` for `Isomap` without searching for neighbors again:
+
+# In[95]:
+
+
+from sklearn.manifold import SpectralEmbedding
+
+X_isomap_reduced = {}
+for n_neighbors in (10, 20, 40):
+    isomap = Isomap(n_components=2, n_neighbors=n_neighbors,
+                    metric="precomputed")
+    X_isomap_reduced[n_neighbors] = isomap.fit_transform(
+        restrict_knn_graph(knn_graph, n_neighbors))
+
+spectral = SpectralEmbedding(n_components=2,
+                             affinity="precomputed_nearest_neighbors",
+                             n_neighbors=10, random_state=42)
+X_spectral_reduced = spectral.fit_transform(restrict_knn_graph(knn_graph, 10))
+
+tsne = TSNE(n_components=2, metric="precomputed", init="random",
+            learning_rate="auto", random_state=42)
+X_tsne_reduced = tsne.fit_transform(knn_graph)
+
+
+# Let's check that we get the same result as when `Isomap` searches for the neighbors itself (this holds as long as no two neighbors are at exactly the same distance, otherwise the ties may be broken differently):
+
+# In[96]:
+
+
+isomap = Isomap(n_components=2, n_neighbors=10, eigen_solver="dense")
+isomap_precomputed = Isomap(n_components=2, n_neighbors=10,
+                            eigen_solver="dense", metric="precomputed")
+np.allclose(np.abs(isomap.fit_transform(X_sample)),
+            np.abs(isomap_precomputed.fit_transform(
+                restrict_knn_graph(knn_graph, 10))))
+
+
+# The second time we build the graph, it's just loaded from disk:
+
+# In[97]:
+
+
+get_ipython().run_line_magic('time', 'knn_graph = build_knn_graph(X_sample, n_neighbors=91)')
+
+
+# In[98]:
+
+
+plt.figure(figsize=(16, 4))
+embeddings = [(f"Isomap, k={n_neighbors}", X_reduced)
+              for n_neighbors, X_reduced in X_isomap_reduced.items()]
+embeddings += [("Spectral embedding, k=10", X_spectral_reduced),
+               ("t-SNE", X_tsne_reduced)]
+for index, (title, X_reduced) in enumerate(embeddings):
+    plt.subplot(1, len(embeddings), index + 1)
+    plt.scatter(X_reduced[:, 0], X_reduced[:, 1],
+                c=y_sample.astype(np.int8), cmap="jet", s=3)
+    plt.title(title)
+    plt.axis("off")
+plt.show()
+
+
+# # Extra Material – Matrix-Free Random Projection
+
+# `GaussianRandomProjection` and `SparseRandomProjection` store the full random matrix, of shape [_d_, _n_]. With a million features and thousands of target dimensions, this matrix alone would take tens of gigabytes. But we don't actually need to store it: since it's random, we can regenerate any block of columns whenever we need it, as long as we use the same seed. We just derive each block's random number generator from the seed _and_ the block index, so every block can be regenerated independently, in any order, by any process. The projection is computed by looping over the feature blocks, generating each block once and applying it to the corresponding columns of the input, chunk by chunk. As long as you use the same seed, block size and NumPy version, you get the same projection on every machine, so different shards of a dataset can be projected independently. If `n_components="auto"`, the number of dimensions is computed using `johnson_lindenstrauss_min_dim()`, based on the number of instances passed to `fit()` (so if you project shards independently, fit the transformer on the full dataset's shape, or set `n_components` explicitly).
+
+# In[99]:
+
+
+from sklearn.base import BaseEstimator, TransformerMixin
+
+class StreamingGaussianRandomProjection(BaseEstimator, TransformerMixin):
+    def __init__(self, n_components="auto", eps=0.1, block_size=10_000,
+                 chunk_size=10_000, random_state=42):
+        self.n_components = n_components
+        self.eps = eps
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+        self.random_state = random_state  # must be an int
+
+    def fit(self, X, y=None):
+        self.n_features_in_ = X.shape[1]
+        if self.n_components == "auto":
+            self.n_components_ = johnson_lindenstrauss_min_dim(X.shape[0],
+                                                               eps=self.eps)
+        else:
+            self.n_components_ = self.n_components
+        return self
+
+    def components_block(self, block_index):
+        start = block_index * self.block_size
+        stop = min(start + self.block_size, self.n_features_in_)
+        rng = np.random.default_rng([self.random_state, block_index])
+        block = rng.standard_normal((self.n_components_, stop - start))
+        return block / np.sqrt(self.n_components_)
+
+    def transform(self, X):
+        X_reduced = np.zeros((X.shape[0], self.n_components_))
+        n_blocks = -(-self.n_features_in_ // self.block_size)  # ceil division
+        for block_index in range(n_blocks):
+            block = self.components_block(block_index)
+            start = block_index * self.block_size
+            X_block = X[:, start:start + self.block_size]
+            for row in range(0, X.shape[0], self.chunk_size):
+                X_reduced[row:row + self.chunk_size] += (
+                    X_block[row:row + self.chunk_size] @ block.T)
+        return X_reduced
+
+
+# Let's try it on a sparse dataset with 1,000 instances and 1 million features. With `eps=0.2`, the Johnson-Lindenstrauss lemma requires about 1,600 dimensions, so the full random matrix would take roughly 13 GB, but we only need one block of 10,000 columns at a time (about 130 MB):
+
+# **Warning**: the following cell takes about a minute to run:
+
+# In[100]:
+
+
+from scipy import sparse
+
+X_wide = sparse.random(1_000, 1_000_000, density=0.001, format="csc",
+                       random_state=np.random.default_rng(42))
+streaming_rnd_proj = StreamingGaussianRandomProjection(eps=0.2)
+X_wide_reduced = streaming_rnd_proj.fit_transform(X_wide)
+X_wide_reduced.shape
+
+
+# The distances between instances are roughly preserved (within ±20%):
+
+# In[101]:
+
+
+from sklearn.metrics import pairwise_distances
+
+distances = pairwise_distances(X_wide[:100])
+distances_reduced = pairwise_distances(X_wide_reduced[:100])
+mask = ~np.eye(100, dtype=bool)
+ratios = distances_reduced[mask] / distances[mask]
+ratios.min(), ratios.max()
+
+
+# And since the projection only depends on the seed, projecting two shards separately (e.g., on different machines) gives the same result as projecting the whole dataset at once, up to floating point rounding errors:
+
+# In[102]:
+
+
+X_shard1_reduced = streaming_rnd_proj.transform(X_wide[:500])
+X_shard2_reduced = streaming_rnd_proj.transform(X_wide[500:])
+np.allclose(np.r_[X_shard1_reduced, X_shard2_reduced], X_wide_reduced)
+
+
 # And that's all for today, I hope you enjoyed this chapter!
 
 # In[ ]:
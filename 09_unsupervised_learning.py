@@ -2094,6 +2094,1216 @@ X_bad_faces_reconstructed = pca.inverse_transform(X_bad_faces_pca)
 plot_faces(X_bad_faces_reconstructed, y_bad)
 
 
+# # Extra Material – Choosing _k_ Faster
+
+# To choose the number of clusters, we trained a brand new `KMeans` model for every value of _k_, and we computed the silhouette score for each one, which requires computing the distances between all pairs of instances: that's O(_m_²), so it does not scale to large datasets. We did it again in exercise 10, with an even larger `k_range`. We can speed this up in several ways:
+# 
+# * When going from one _k_ to the next, we can _warm start_ K-Means from the previous centroids: we just split the cluster with the largest inertia in two (by running a 2-means on its instances), and we repeat until we get the desired number of centroids (e.g., 5 splits if we go from _k_ = 5 to _k_ = 10), then we run K-Means from there, with a single initialization. This usually converges in just a few iterations.
+# * The warm starts make each _k_ depend on the previous one, but we can still split the range of _k_ values into a few contiguous chains, and run the chains in parallel.
+# * We can estimate the silhouette score on a sample of the instances rather than on the whole dataset. To reduce the variance of this estimate, the sample is stratified by cluster: each cluster gets a share of the sample proportional to its size (and at least 2 instances, or 1 if that's all the cluster has: the silhouette coefficient of an instance alone in its cluster is 0 by definition, so such a cluster adds no uncertainty). This also lets us compute a confidence interval for the silhouette score.
+
+# In[144]:
+
+
+import time
+
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.metrics import pairwise_distances_argmin_min, silhouette_samples
+
+def split_worst_clusters(X, centroids, n_splits=1, random_state=42):
+    for _ in range(n_splits):
+        labels, distances = pairwise_distances_argmin_min(X, centroids)
+        cluster_inertias = np.bincount(labels, weights=distances ** 2,
+                                       minlength=len(centroids))
+        worst_cluster = cluster_inertias.argmax()
+        two_means = KMeans(n_clusters=2, n_init=1, random_state=random_state)
+        two_means.fit(X[labels == worst_cluster])
+        other_centroids = np.delete(centroids, worst_cluster, axis=0)
+        centroids = np.r_[other_centroids, two_means.cluster_centers_]
+    return centroids
+
+def sampled_silhouette_score(X, labels, sample_size=10_000, confidence=0.95,
+                             random_state=42):
+    rng = np.random.default_rng(random_state)
+    cluster_ids, cluster_sizes = np.unique(labels, return_counts=True)
+    weights = cluster_sizes / len(X)
+    # at least 2 draws per cluster (to estimate its variance), but never more
+    # than the cluster's size, since we sample without replacement
+    n_per_cluster = np.round(weights * sample_size).astype(int).clip(min=2)
+    n_per_cluster = np.minimum(n_per_cluster, cluster_sizes)
+    sample_indices = np.concatenate([
+        rng.choice(np.flatnonzero(labels == cluster_id), n, replace=False)
+        for cluster_id, n in zip(cluster_ids, n_per_cluster)])
+    coefficients = silhouette_samples(X[sample_indices], labels[sample_indices])
+    sample_labels = labels[sample_indices]
+    means = np.array([coefficients[sample_labels == cluster_id].mean()
+                      for cluster_id in cluster_ids])
+    # singleton clusters are fully sampled, so they add no variance
+    variances = np.array([coefficients[sample_labels == cluster_id].var(ddof=1)
+                          if n > 1 else 0.0
+                          for cluster_id, n in zip(cluster_ids, n_per_cluster)])
+    # stratified estimate of the mean, and of its variance
+    score = weights @ means
+    finite_population = 1 - n_per_cluster / cluster_sizes
+    std_error = np.sqrt(np.sum(weights ** 2 * variances / n_per_cluster
+                               * finite_population))
+    z = stats.norm.ppf((1 + confidence) / 2)
+    return score, score - z * std_error, score + z * std_error
+
+def fit_k_chain(X, k_chain, sample_size, random_state):
+    results = []
+    kmeans = None
+    for k in k_chain:
+        start = time.perf_counter()
+        if kmeans is None or k <= kmeans.n_clusters:
+            kmeans = KMeans(n_clusters=k, random_state=random_state)
+        else:
+            init = split_worst_clusters(X, kmeans.cluster_centers_,
+                                        k - kmeans.n_clusters, random_state)
+            kmeans = KMeans(n_clusters=k, init=init, n_init=1,
+                            random_state=random_state)
+        kmeans.fit(X)
+        fit_time = time.perf_counter() - start
+        start = time.perf_counter()
+        if k > 1:
+            silhouette, ci_low, ci_high = sampled_silhouette_score(
+                X, kmeans.labels_, sample_size, random_state=random_state)
+        else:
+            silhouette, ci_low, ci_high = np.nan, np.nan, np.nan
+        silhouette_time = time.perf_counter() - start
+        results.append({"k": k, "inertia": kmeans.inertia_,
+                        "silhouette": silhouette, "silhouette_ci_low": ci_low,
+                        "silhouette_ci_high": ci_high, "fit_time": fit_time,
+                        "silhouette_time": silhouette_time, "model": kmeans})
+    return results
+
+def select_k(X, k_range, sample_size=10_000, n_chains=4, n_jobs=-1,
+             random_state=42):
+    k_chains = np.array_split(np.array(k_range), n_chains)
+    chain_results = Parallel(n_jobs=n_jobs)(
+        delayed(fit_k_chain)(X, k_chain, sample_size, random_state)
+        for k_chain in k_chains if len(k_chain) > 0)
+    return pd.DataFrame([result for results in chain_results
+                         for result in results]).set_index("k")
+
+
+# Let's try it on a larger version of the blobs dataset we used at the beginning of this chapter:
+
+# In[145]:
+
+
+X_many_blobs, _ = make_blobs(n_samples=200_000, centers=blob_centers,
+                             cluster_std=blob_std, random_state=7)
+get_ipython().run_line_magic('time', 'k_selection = select_k(X_many_blobs, range(1, 10), sample_size=5_000)')
+k_selection.drop(columns="model").round(3)
+
+
+# We find the same elbow and the same silhouette peak at _k_ = 4 as earlier, in a fraction of the time. The confidence intervals show which differences between values of _k_ are significant:
+
+# In[146]:
+
+
+plt.figure(figsize=(10, 3.5))
+
+plt.subplot(121)
+plt.plot(k_selection.index, k_selection["inertia"], "bo-")
+plt.xlabel("$k$")
+plt.ylabel("Inertia")
+plt.grid()
+
+plt.subplot(122)
+silhouette = k_selection["silhouette"]
+plt.errorbar(k_selection.index, silhouette,
+             yerr=[silhouette - k_selection["silhouette_ci_low"],
+                   k_selection["silhouette_ci_high"] - silhouette],
+             fmt="bo-", capsize=3)
+plt.xlabel("$k$")
+plt.ylabel("Silhouette score")
+plt.grid()
+
+plt.show()
+
+
+# For comparison, here's how long it takes to train a fresh model for each _k_ and compute the exact silhouette score on just 20,000 of these instances (the exact computation would run out of memory on all 200,000 instances):
+
+# In[147]:
+
+
+X_some_blobs = X_many_blobs[:20_000]
+get_ipython().run_line_magic('time', '[silhouette_score(X_some_blobs, KMeans(n_clusters=k, random_state=42).fit_predict(X_some_blobs)) for k in range(2, 10)]')
+
+
+# Lastly, let's run it on the Olivetti faces from exercise 10. The dataset is small enough that the "sample" is actually the whole training set, so we get the exact silhouette scores:
+
+# In[148]:
+
+
+k_selection_faces = select_k(X_train_pca, k_range)
+k_selection_faces["silhouette"].idxmax()
+
+
+# # Extra Material – A Clustering Benchmark Harness
+
+# The code that generated Figure 9–6 used `timeit()` on a single dataset, in the notebook's process: the results depend on whatever else was running in that process (warm caches, previous allocations, thread pools), there's no warmup, and they are not saved anywhere. Let's write a reusable benchmark harness instead. For each configuration (algorithm, number of instances _m_, number of clusters _k_, number of dimensions _n_), it:
+# 
+# * runs in a fresh worker process, so configurations cannot affect each other;
+# * generates a blobs dataset, and performs a warmup fit on a small subset (the blobs have a standard deviation of 1 along each axis, so BIRCH's threshold is scaled with √_n_, while DBSCAN's `eps` is set to the 90th percentile of the distances between the instances and their 5th nearest neighbor, computed on a sample of 1,000 instances: this is the usual _k_-distance heuristic, and a fixed `eps` would flag every instance as noise in high dimensions, since the instances are very far apart);
+# * measures the fit and predict latencies over several repeats (keeping the median), then measures the peak memory allocated during one more fit, using `tracemalloc` (in a separate run, since tracing slows down allocations);
+# * records the final inertia (computed from the predicted labels, so it's comparable across algorithms, ignoring DBSCAN's noise instances) and, for Gaussian mixtures, the mean log-likelihood.
+# 
+# The results are saved to both JSON and CSV, along with the library versions, so you can diff them across versions or machines.
+
+# **Note**: the worker processes are started by joblib's loky backend, which launches fresh Python processes instead of forking the notebook's process: forking a process after it has used OpenMP thread pools (as `KMeans` does) can deadlock the child process. Loky also pickles the functions using cloudpickle, so the functions defined in this notebook can be used by the workers on every platform.
+
+# In[149]:
+
+
+import json
+import platform
+import tracemalloc
+
+import sklearn
+from joblib.externals.loky import get_reusable_executor
+from sklearn.base import clone
+from sklearn.cluster import Birch, DBSCAN
+from sklearn.neighbors import NearestNeighbors
+
+def knn_distance_quantile(X, n_neighbors=5, quantile=0.9, n_queries=1000):
+    rng = np.random.default_rng(42)
+    X_queries = X[rng.choice(len(X), size=min(n_queries, len(X)),
+                             replace=False)]
+    # each query instance is its own nearest neighbor, like in DBSCAN
+    distances, _ = NearestNeighbors(n_neighbors=n_neighbors).fit(X).kneighbors(
+        X_queries)
+    return np.quantile(distances[:, -1], quantile)
+
+CLUSTERING_ALGORITHMS = {
+    "kmeans_lloyd": lambda k, X: KMeans(n_clusters=k, algorithm="lloyd",
+                                        n_init=1, random_state=42),
+    "kmeans_elkan": lambda k, X: KMeans(n_clusters=k, algorithm="elkan",
+                                        n_init=1, random_state=42),
+    "minibatch_kmeans": lambda k, X: MiniBatchKMeans(n_clusters=k, n_init=1,
+                                                     random_state=42),
+    "birch": lambda k, X: Birch(n_clusters=k, threshold=np.sqrt(X.shape[1])),
+    "dbscan": lambda k, X: DBSCAN(eps=knn_distance_quantile(X), min_samples=5),
+    "gaussian_mixture": lambda k, X: GaussianMixture(n_components=k,
+                                                     random_state=42),
+}
+
+def labels_inertia(X, labels):
+    inertia = 0.0
+    for label in np.unique(labels[labels >= 0]):
+        X_cluster = X[labels == label]
+        inertia += np.square(X_cluster - X_cluster.mean(axis=0)).sum()
+    return inertia
+
+def run_clustering_config(algorithm, n_samples, n_clusters, n_features,
+                          n_repeats=3, warmup_size=1000):
+    X, _ = make_blobs(n_samples=n_samples, centers=n_clusters,
+                      n_features=n_features, random_state=42)
+    # the hyperparameters are computed once, on the full dataset
+    prototype = CLUSTERING_ALGORITHMS[algorithm](n_clusters, X)
+    clone(prototype).fit(X[:warmup_size])  # warmup
+    fit_times, predict_times = [], []
+    for _ in range(n_repeats):
+        clusterer = clone(prototype)
+        start = time.perf_counter()
+        clusterer.fit(X)
+        fit_times.append(time.perf_counter() - start)
+        if hasattr(clusterer, "predict"):
+            start = time.perf_counter()
+            labels = clusterer.predict(X)
+            predict_times.append(time.perf_counter() - start)
+        else:  # DBSCAN
+            labels = clusterer.labels_
+    tracemalloc.start()
+    clone(prototype).fit(X)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "algorithm": algorithm, "n_samples": n_samples,
+        "n_clusters": n_clusters, "n_features": n_features,
+        "fit_time": np.median(fit_times),
+        "predict_time": np.median(predict_times) if predict_times else None,
+        "peak_memory": peak_memory,
+        "inertia": labels_inertia(X, labels),
+        "log_likelihood": (clusterer.score(X)
+                           if isinstance(clusterer, GaussianMixture) else None),
+    }
+
+def benchmark_clustering(algorithms, sample_sizes, cluster_counts,
+                         feature_counts, n_repeats=3,
+                         report_path=Path("my_clustering_benchmark")):
+    results = []
+    for algorithm in algorithms:
+        for n_samples in sample_sizes:
+            for n_clusters in cluster_counts:
+                for n_features in feature_counts:
+                    print(f"\r{algorithm} m={n_samples} k={n_clusters} "
+                          f"n={n_features}", end=" " * 10)
+                    # a new single-use worker for each configuration
+                    executor = get_reusable_executor(max_workers=1,
+                                                     reuse=False)
+                    try:
+                        results.append(executor.submit(
+                            run_clustering_config, algorithm, n_samples,
+                            n_clusters, n_features, n_repeats).result())
+                    finally:
+                        executor.shutdown(wait=True)
+    report = pd.DataFrame(results)
+    metadata = {"sklearn": sklearn.__version__, "numpy": np.__version__,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "processor": platform.processor()}
+    report_path.with_suffix(".json").write_text(json.dumps(
+        {"metadata": metadata,
+         "results": json.loads(report.to_json(orient="records"))},
+        indent=2))
+    report.to_csv(report_path.with_suffix(".csv"), index=False)
+    return report
+
+
+# **Warning**: the following cell takes several minutes to run:
+
+# In[150]:
+
+
+clustering_report = benchmark_clustering(
+    algorithms=list(CLUSTERING_ALGORITHMS),
+    sample_sizes=[10_000, 50_000], cluster_counts=[5, 50],
+    feature_counts=[2, 20])
+clustering_report.round(4)
+
+
+# For example, here's how the fit time scales with _k_ for each algorithm, on the largest dataset:
+
+# In[151]:
+
+
+largest = clustering_report[(clustering_report["n_samples"] == 50_000)
+                            & (clustering_report["n_features"] == 20)]
+largest.pivot(index="n_clusters", columns="algorithm", values="fit_time")
+
+
+# # Extra Material – Computing Silhouette Coefficients Under a Memory Cap
+
+# `silhouette_samples()` needs the distance between every pair of instances. Scikit-Learn computes them chunk by chunk, but every chunk spans the whole dataset, so its memory usage still grows with _m_, and it always computes all _m_² distances. Let's write an implementation that sorts the instances by cluster, then computes the distances tile by tile: each tile pairs a block of rows with a block of instances from a single cluster, so we can directly accumulate the sum of distances from each row to each cluster. The tile size is chosen so that all the threads together stay under a user-defined memory cap: that's the main benefit of this implementation. The row blocks are processed by a thread pool (NumPy releases the GIL during the heavy computations), which helps on a multicore machine, but on a single core this implementation is no faster than `silhouette_samples()`. In sampled mode, we only compute the coefficients of a random sample of instances (exactly, against all the instances), and the other coefficients are set to NaN (if `sample_size` is not smaller than the dataset, all the coefficients are computed). The distances are computed using `euclidean_distances()`, like Scikit-Learn does.
+
+# In[152]:
+
+
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.metrics.pairwise import euclidean_distances
+
+def chunked_silhouette_samples(X, labels, memory_cap=256 * 2**20,
+                               n_threads=4, sample_size=None,
+                               random_state=42):
+    cluster_ids, labels_idx, cluster_sizes = np.unique(
+        labels, return_inverse=True, return_counts=True)
+    order = np.argsort(labels_idx, kind="stable")
+    X_sorted = X[order]
+    cluster_starts = np.r_[0, np.cumsum(cluster_sizes)]
+    if sample_size is None or sample_size >= len(X):
+        rows = np.arange(len(X))
+    else:
+        rng = np.random.default_rng(random_state)
+        rows = np.sort(rng.choice(len(X), sample_size, replace=False))
+    # each thread holds a tile and a temporary copy of the same size
+    tile_size = max(1, int(np.sqrt(memory_cap / (2 * 8 * n_threads))))
+
+    def cluster_distance_sums(row_block):
+        X_rows = X[row_block]
+        sums = np.zeros((len(row_block), len(cluster_ids)))
+        for cluster_idx in range(len(cluster_ids)):
+            start, stop = cluster_starts[cluster_idx: cluster_idx + 2]
+            for col_start in range(start, stop, tile_size):
+                col_stop = min(col_start + tile_size, stop)
+                distances = euclidean_distances(X_rows,
+                                                X_sorted[col_start:col_stop])
+                sums[:, cluster_idx] += distances.sum(axis=1)
+        return sums
+
+    row_blocks = [rows[start:start + tile_size]
+                  for start in range(0, len(rows), tile_size)]
+    with ThreadPoolExecutor(n_threads) as executor:
+        sums = np.concatenate(list(executor.map(cluster_distance_sums,
+                                                row_blocks)))
+
+    own_cluster = labels_idx[rows]
+    own_sizes = cluster_sizes[own_cluster]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a = sums[np.arange(len(rows)), own_cluster] / (own_sizes - 1)
+        mean_distances = sums / cluster_sizes
+        mean_distances[np.arange(len(rows)), own_cluster] = np.inf
+        b = mean_distances.min(axis=1)
+        coefficients = np.nan_to_num((b - a) / np.maximum(a, b))
+    coefficients[own_sizes == 1] = 0.0  # like Scikit-Learn
+    all_coefficients = np.full(len(X), np.nan)
+    all_coefficients[rows] = coefficients
+    return all_coefficients
+
+def chunked_silhouette_score(X, labels, **kwargs):
+    return np.nanmean(chunked_silhouette_samples(X, labels, **kwargs))
+
+
+# Let's check that we get the same coefficients as Scikit-Learn on the blobs dataset:
+
+# In[153]:
+
+
+X_blobs, _ = make_blobs(n_samples=2000, centers=blob_centers,
+                        cluster_std=blob_std, random_state=7)
+y_pred = KMeans(n_clusters=5, random_state=42).fit_predict(X_blobs)
+silhouette_coefficients = chunked_silhouette_samples(X_blobs, y_pred,
+                                                     memory_cap=2**20)
+np.allclose(silhouette_coefficients, silhouette_samples(X_blobs, y_pred))
+
+
+# Since the result is a regular array of coefficients, the silhouette diagram code keeps working, e.g., `silhouette_coefficients[y_pred == i]`. In sampled mode, however, the coefficients of the instances that were not sampled are NaN, so you must drop them before sorting the coefficients of each cluster, e.g., using `coefficients[(y_pred == i) & ~np.isnan(coefficients)]`, or else the diagram will be wrong. Now let's compute the silhouette score on 200,000 instances, with a 100 MB memory cap, both exactly and on a sample of 10,000 instances:
+
+# **Warning**: the exact computation takes several minutes:
+
+# In[154]:
+
+
+y_pred_many = KMeans(n_clusters=5, random_state=42).fit_predict(X_many_blobs)
+get_ipython().run_line_magic('time', 'exact_score = chunked_silhouette_score(X_many_blobs, y_pred_many, memory_cap=100 * 2**20)')
+get_ipython().run_line_magic('time', 'sampled_score = chunked_silhouette_score(X_many_blobs, y_pred_many, memory_cap=100 * 2**20, sample_size=10_000)')
+exact_score, sampled_score
+
+
+# # Extra Material – Fast Color Quantization
+
+# In the image segmentation section, we trained a new K-Means model on all the pixels for each number of colors, and then built `kmeans.cluster_centers_[kmeans.labels_]`: a full-resolution image of 64-bit floats (that's 24 bytes per pixel). This is fine for a single image, but it's much too slow for 4K videos. Instead, we can:
+# 
+# * train K-Means on a color histogram rather than on the pixels: we reduce each color channel to 5 bits, count how many pixels fall in each of the 32 × 32 × 32 color bins, and train K-Means on the non-empty bins, weighted by their pixel counts;
+# * precompute a 3-D lookup table (LUT) mapping every color (with each channel reduced to 6 bits, so there are 64 × 64 × 64 = 262,144 entries) to the index of its nearest centroid;
+# * segment each image using a single LUT lookup per pixel, which outputs a palette-indexed image of `uint8` (1 byte per pixel), plus a palette of up to 256 colors.
+
+# In[155]:
+
+
+class ColorQuantizer:
+    def __init__(self, n_colors=8, hist_bits=5, lut_bits=6, random_state=42):
+        self.n_colors = n_colors
+        self.hist_bits = hist_bits
+        self.lut_bits = lut_bits
+        self.random_state = random_state
+
+    @staticmethod
+    def _bin_centers(n_bits):
+        bin_width = 2 ** (8 - n_bits)
+        return np.arange(2 ** n_bits) * bin_width + bin_width / 2
+
+    def fit(self, image):
+        n_bins = 2 ** self.hist_bits
+        pixels = image.reshape(-1, 3) >> (8 - self.hist_bits)
+        codes = (pixels[:, 0].astype(np.int32) * n_bins + pixels[:, 1]) * n_bins
+        counts = np.bincount(codes + pixels[:, 2], minlength=n_bins ** 3)
+        nonempty_codes = np.flatnonzero(counts)
+        colors = np.c_[np.unravel_index(nonempty_codes, (n_bins,) * 3)]
+        kmeans = KMeans(n_clusters=self.n_colors, random_state=self.random_state)
+        kmeans.fit(self._bin_centers(self.hist_bits)[colors],
+                   sample_weight=counts[nonempty_codes])
+        self.palette_ = kmeans.cluster_centers_.round().astype(np.uint8)
+        bin_centers = self._bin_centers(self.lut_bits)
+        grid = np.stack(np.meshgrid(bin_centers, bin_centers, bin_centers,
+                                    indexing="ij"), axis=-1).reshape(-1, 3)
+        self.lut_ = kmeans.predict(grid).astype(np.uint8).reshape(
+            (2 ** self.lut_bits,) * 3)
+        return self
+
+    def transform(self, image):
+        shift = 8 - self.lut_bits
+        return self.lut_[image[..., 0] >> shift, image[..., 1] >> shift,
+                         image[..., 2] >> shift]
+
+    def inverse_transform(self, palette_indices):
+        return self.palette_[palette_indices]
+
+
+# Let's use it to segment the ladybug image:
+
+# In[156]:
+
+
+color_quantizer = ColorQuantizer(n_colors=8).fit(image)
+palette_indices = color_quantizer.transform(image)
+palette_indices.dtype, palette_indices.shape
+
+
+# In[157]:
+
+
+plt.figure(figsize=(10, 4))
+plt.subplot(121)
+plt.imshow(segmented_imgs[n_colors.index(8)] / 255)
+plt.title("K-Means on all pixels")
+plt.axis("off")
+plt.subplot(122)
+plt.imshow(color_quantizer.inverse_transform(palette_indices))
+plt.title("Histogram + LUT")
+plt.axis("off")
+plt.show()
+
+
+# Both images look the same. Now let's compare the speed and memory usage on a 4K frame (3840 × 2160 pixels), built by tiling the ladybug image:
+
+# In[158]:
+
+
+frame = np.tile(image, (5, 5, 1))[:2160, :3840]
+pixels = image.reshape(-1, 3)
+kmeans_baseline = KMeans(n_clusters=8, random_state=42).fit(pixels)
+get_ipython().run_line_magic('timeit', 'kmeans_baseline.cluster_centers_[kmeans_baseline.predict(frame.reshape(-1, 3))]')
+get_ipython().run_line_magic('timeit', 'color_quantizer.transform(frame)')
+
+
+# In[159]:
+
+
+segmented_frame = kmeans_baseline.cluster_centers_[
+    kmeans_baseline.predict(frame.reshape(-1, 3))]
+print(f"K-Means output: {segmented_frame.nbytes / 2**20:.0f} MB")
+print(f"Palette-indexed output: {color_quantizer.transform(frame).nbytes / 2**20:.0f} MB")
+
+
+# Training is much faster too, since the histogram contains far fewer colors than the image contains pixels:
+
+# In[160]:
+
+
+get_ipython().run_line_magic('timeit', '-n 1 -r 1 KMeans(n_clusters=8, random_state=42).fit(pixels)')
+get_ipython().run_line_magic('timeit', '-n 1 -r 1 ColorQuantizer(n_colors=8).fit(image)')
+
+
+# # Extra Material – Vectorized Label Propagation and Active Learning
+
+# In the semi-supervised learning section, we propagated the labels and removed the outliers using Python loops over the clusters. With 50 clusters that's fine, but with a large unlabeled pool and many clusters, each loop iteration scans the whole dataset, so it gets slow. Both steps can be done in a single vectorized pass:
+# 
+# * label propagation is just a lookup: `y_representative[cluster_labels]`;
+# * for outlier filtering, we sort the instances by cluster, then by distance to their centroid (using `np.lexsort()`), and we compute every cluster's percentile at once by indexing this sorted array, using the same linear interpolation as `np.percentile()`.
+
+# In[161]:
+
+
+def propagate_labels(cluster_labels, y_representative):
+    return np.asarray(y_representative)[cluster_labels]
+
+def per_cluster_percentile(cluster_labels, cluster_dist, percentile,
+                           n_clusters=None):
+    if n_clusters is None:
+        n_clusters = cluster_labels.max() + 1
+    sorted_dist = cluster_dist[np.lexsort((cluster_dist, cluster_labels))]
+    counts = np.bincount(cluster_labels, minlength=n_clusters)
+    starts = np.r_[0, counts.cumsum()[:-1]]
+    nonempty = counts > 0
+    position = (counts[nonempty] - 1) * percentile / 100
+    low = np.floor(position).astype(np.int64)
+    high = np.minimum(low + 1, counts[nonempty] - 1)
+    low_dist = sorted_dist[starts[nonempty] + low]
+    high_dist = sorted_dist[starts[nonempty] + high]
+    cutoffs = np.full(n_clusters, np.inf)
+    cutoffs[nonempty] = low_dist + (position - low) * (high_dist - low_dist)
+    return cutoffs
+
+def closest_to_centroid_mask(cluster_labels, cluster_dist, percentile):
+    cutoffs = per_cluster_percentile(cluster_labels, cluster_dist, percentile)
+    return cluster_dist <= cutoffs[cluster_labels]
+
+
+# Let's check that we get exactly the same results as the loops from the semi-supervised learning section. Since `X_train`, `kmeans`, and so on now refer to other datasets and models, we first rebuild the digits training set and the K-Means model with 50 clusters, under new names. We use the same random state as earlier, so the clusters are the same, and the representative digits' labels still apply:
+
+# In[162]:
+
+
+X_digits_train, y_digits_train = X_digits[:1400], y_digits[:1400]
+X_digits_test, y_digits_test = X_digits[1400:], y_digits[1400:]
+kmeans_digits = KMeans(n_clusters=50, random_state=42)
+X_digits_train_dist = kmeans_digits.fit_transform(X_digits_train)
+digits_representative_idx = X_digits_train_dist.argmin(axis=0)
+digits_cluster_labels = kmeans_digits.labels_
+digits_cluster_dist = X_digits_train_dist[np.arange(len(X_digits_train)),
+                                          digits_cluster_labels]
+
+
+# In[163]:
+
+
+# extra code – the loops from the semi-supervised learning section
+y_digits_propagated_loop = np.empty(len(X_digits_train), dtype=np.int64)
+for i in range(50):
+    y_digits_propagated_loop[digits_cluster_labels == i] = (
+        y_representative_digits[i])
+
+digits_cluster_dist_loop = digits_cluster_dist.copy()
+for i in range(50):
+    in_cluster = (digits_cluster_labels == i)
+    cluster_dist = digits_cluster_dist_loop[in_cluster]
+    cutoff_distance = np.percentile(cluster_dist, percentile_closest)
+    above_cutoff = (digits_cluster_dist_loop > cutoff_distance)
+    digits_cluster_dist_loop[in_cluster & above_cutoff] = -1
+
+
+# In[164]:
+
+
+y_propagated = propagate_labels(digits_cluster_labels, y_representative_digits)
+closest_mask = closest_to_centroid_mask(digits_cluster_labels,
+                                        digits_cluster_dist, percentile_closest)
+((y_propagated == y_digits_propagated_loop).all()
+ and (closest_mask == (digits_cluster_dist_loop != -1)).all())
+
+
+# Now let's implement a round of *active learning*: we want to ask a human expert to label the instances the model is least sure about, preferably in distinct clusters. For this, we compute the model's confidence (i.e., its highest estimated class probability) for every unlabeled instance, we keep the least confident instance in each cluster (again using a single `np.lexsort()`), and we return the `batch_size` least confident ones among these. If `cluster_labels` is `None`, we just return the `batch_size` least confident instances overall, using `np.argpartition()`, which avoids sorting the whole pool.
+
+# In[165]:
+
+
+def least_confident_instances(model, X_pool, batch_size, cluster_labels=None,
+                              chunk_size=100_000):
+    confidence = np.concatenate([
+        model.predict_proba(X_pool[start:start + chunk_size]).max(axis=1)
+        for start in range(0, len(X_pool), chunk_size)
+    ])
+    candidates = np.arange(len(X_pool))
+    if cluster_labels is not None:
+        by_cluster = np.lexsort((confidence, cluster_labels))
+        _, first = np.unique(cluster_labels[by_cluster], return_index=True)
+        candidates = by_cluster[first]
+    batch_size = min(batch_size, len(candidates))
+    least_confident = np.argpartition(confidence[candidates],
+                                      batch_size - 1)[:batch_size]
+    selected = candidates[least_confident]
+    return selected[np.argsort(confidence[selected])]
+
+def active_learning_round(model, X, y_known, labeled, oracle, batch_size,
+                          cluster_labels=None):
+    model.fit(X[y_known != -1], y_known[y_known != -1])
+    pool_idx = np.flatnonzero(~labeled)
+    pool_clusters = None if cluster_labels is None else cluster_labels[pool_idx]
+    queried = pool_idx[least_confident_instances(model, X[pool_idx], batch_size,
+                                                 pool_clusters)]
+    y_known = y_known.copy()
+    y_known[queried] = oracle(queried)
+    labeled = labeled.copy()
+    labeled[queried] = True
+    return y_known, labeled
+
+
+# `y_known` contains the labels used for training (-1 means no label): initially these are the propagated labels of the instances closest to their centroid. The `labeled` mask identifies the instances that were labeled by the expert. Let's run a few rounds, using the true labels to play the role of the expert (the `oracle` function), and let's measure the model's accuracy on the test set after each round:
+
+# In[166]:
+
+
+y_known = np.where(closest_mask, y_propagated, -1)
+labeled = np.zeros(len(X_digits_train), dtype=bool)
+labeled[digits_representative_idx] = True
+log_reg_digits = LogisticRegression(max_iter=10_000)
+for round_index in range(5):
+    y_known, labeled = active_learning_round(
+        log_reg_digits, X_digits_train, y_known, labeled,
+        oracle=lambda idx: y_digits_train[idx], batch_size=20,
+        cluster_labels=digits_cluster_labels)
+    log_reg_digits.fit(X_digits_train[y_known != -1], y_known[y_known != -1])
+    accuracy = log_reg_digits.score(X_digits_test, y_digits_test)
+    print(f"Round #{round_index + 1}: {labeled.sum()} labeled instances, "
+          f"accuracy={accuracy:.1%}")
+
+
+# Now let's check that these functions remain interactive on a pool of 1 million unlabeled instances, split across 1,000 clusters. The Python loops from earlier take several seconds, while the vectorized version takes a fraction of a second:
+
+# In[167]:
+
+
+rng = np.random.default_rng(42)
+n_pool, n_pool_clusters = 1_000_000, 1_000
+pool_labels = rng.integers(0, n_pool_clusters, size=n_pool)
+pool_dist = rng.random(n_pool)
+pool_y_representative = rng.integers(0, 10, size=n_pool_clusters)
+
+
+# In[168]:
+
+
+get_ipython().run_cell_magic('time', '', 'pool_y_loop = np.empty(n_pool, dtype=np.int64)\nfor i in range(n_pool_clusters):\n    pool_y_loop[pool_labels == i] = pool_y_representative[i]\n\npool_dist_loop = pool_dist.copy()\nfor i in range(n_pool_clusters):\n    in_cluster = (pool_labels == i)\n    cutoff_distance = np.percentile(pool_dist_loop[in_cluster], percentile_closest)\n    pool_dist_loop[in_cluster & (pool_dist_loop > cutoff_distance)] = -1\n')
+
+
+# In[169]:
+
+
+get_ipython().run_cell_magic('time', '', 'pool_y = propagate_labels(pool_labels, pool_y_representative)\npool_mask = closest_to_centroid_mask(pool_labels, pool_dist,\n                                     percentile_closest)\n')
+
+
+# In[170]:
+
+
+(pool_y == pool_y_loop).all() and (pool_mask == (pool_dist_loop != -1)).all()
+
+
+# In[171]:
+
+
+X_pool = rng.random((n_pool, X_digits_train.shape[1]), dtype=np.float32) * 16
+get_ipython().run_line_magic('time', 'least_confident_instances(log_reg_digits, X_pool, batch_size=20, cluster_labels=pool_labels)')
+
+
+# # Extra Material – Fast DBSCAN Parameter Sweeps
+
+# Tuning DBSCAN's hyperparameters usually means fitting many `DBSCAN` models with various `eps` and `min_samples` values, and each fit searches for all the neighbors of every instance, which is by far the most expensive step. However, if we compute the sparse radius-neighbors graph just once, using the largest `eps` we are interested in, then the neighborhoods for any smaller `eps` are obtained by simply dropping the edges that are too long. The rest of the algorithm is cheap:
+# 
+# * the core instances are the ones with at least `min_samples` neighbors (including themselves);
+# * the clusters are the connected components of the graph restricted to the core instances. Just like `DBSCAN`, we number them in the order of their first core instance;
+# * each border instance joins the cluster of one of its core neighbors: `DBSCAN` visits the clusters in order, so it is the one with the lowest cluster number;
+# * all other instances are anomalies.
+# 
+# Each clustering is cached, and the first time we make predictions with it, we also build and cache a `KDTree` on its core instances, so we can quickly predict the cluster of new instances: a new instance belongs to the cluster of its nearest core instance, if it lies within `eps` of it, else it's an anomaly (just like we did with the `KNeighborsClassifier` earlier).
+
+# In[172]:
+
+
+from collections import namedtuple
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from sklearn.neighbors import KDTree, NearestNeighbors
+
+DBSCANClustering = namedtuple("DBSCANClustering",
+                              ["labels", "core_sample_indices"])
+
+class DBSCANSweep:
+    def __init__(self, max_eps=0.5, algorithm="auto", n_jobs=None):
+        self.max_eps = max_eps
+        self.algorithm = algorithm
+        self.n_jobs = n_jobs
+
+    def fit(self, X):
+        self.X_ = X
+        nn = NearestNeighbors(radius=self.max_eps, algorithm=self.algorithm,
+                              n_jobs=self.n_jobs).fit(X)
+        graph = nn.radius_neighbors_graph(mode="distance")  # excludes self
+        graph.sort_indices()
+        graph = graph.tocoo()
+        self.rows_, self.cols_, self.dists_ = graph.row, graph.col, graph.data
+        self.clusterings_ = {}
+        self.core_trees_ = {}
+        return self
+
+    def cluster(self, eps, min_samples=5):
+        if eps > self.max_eps:
+            raise ValueError(f"eps={eps} is greater than max_eps={self.max_eps}")
+        key = (eps, min_samples)
+        if key not in self.clusterings_:
+            self.clusterings_[key] = self._cluster(eps, min_samples)
+        return self.clusterings_[key]
+
+    def _cluster(self, eps, min_samples):
+        n_samples = len(self.X_)
+        in_range = self.dists_ <= eps
+        rows, cols = self.rows_[in_range], self.cols_[in_range]
+        n_neighbors = np.bincount(rows, minlength=n_samples) + 1
+        is_core = n_neighbors >= min_samples
+        core_sample_indices = np.flatnonzero(is_core)
+
+        # the edges are sorted (by row then column) and the graph is symmetric,
+        # so we can build the CSR matrix directly and use the "strong" algorithm
+        core_edges = is_core[rows] & is_core[cols]
+        core_indptr = np.r_[0, np.bincount(rows[core_edges],
+                                           minlength=n_samples).cumsum()]
+        core_graph = csr_matrix(
+            (np.ones(core_edges.sum(), dtype=np.int8), cols[core_edges],
+             core_indptr), shape=(n_samples, n_samples))
+        core_graph.has_sorted_indices = True
+        _, components = connected_components(core_graph, connection="strong")
+        core_components = components[core_sample_indices]
+        unique_components, first_index = np.unique(core_components,
+                                                   return_index=True)
+        component_labels = np.empty(components.max() + 1, dtype=np.int64)
+        component_labels[unique_components[np.argsort(first_index)]] = np.arange(
+            len(unique_components))
+
+        labels = np.full(n_samples, n_samples, dtype=np.int64)
+        labels[core_sample_indices] = component_labels[core_components]
+        border_edges = ~is_core[rows] & is_core[cols]
+        np.minimum.at(labels, rows[border_edges], labels[cols[border_edges]])
+        labels[labels == n_samples] = -1
+        return DBSCANClustering(labels, core_sample_indices)
+
+    def sweep(self, eps_values, min_samples_values):
+        rows = []
+        for eps in eps_values:
+            for min_samples in min_samples_values:
+                labels = self.cluster(eps, min_samples).labels
+                rows.append({"eps": eps, "min_samples": min_samples,
+                             "n_clusters": labels.max() + 1,
+                             "anomaly_ratio": (labels == -1).mean()})
+        return pd.DataFrame(rows)
+
+    def predict(self, X_new, eps, min_samples=5):
+        clustering = self.cluster(eps, min_samples)
+        y_pred = np.full(len(X_new), -1, dtype=np.int64)
+        if len(clustering.core_sample_indices) == 0:
+            return y_pred
+        key = (eps, min_samples)
+        if key not in self.core_trees_:
+            core_samples = self.X_[clustering.core_sample_indices]
+            self.core_trees_[key] = KDTree(core_samples)
+        dist, idx = self.core_trees_[key].query(X_new, k=1)
+        core_labels = clustering.labels[clustering.core_sample_indices]
+        within_eps = dist[:, 0] <= eps
+        y_pred[within_eps] = core_labels[idx[within_eps, 0]]
+        return y_pred
+
+
+# Let's check that we get exactly the same clusterings as `DBSCAN` on the moons dataset, for a few combinations of hyperparameters:
+
+# In[173]:
+
+
+X, y = make_moons(n_samples=1000, noise=0.05, random_state=42)
+dbscan_sweep = DBSCANSweep(max_eps=0.2).fit(X)
+all(
+    (dbscan_sweep.cluster(eps, min_samples).labels
+     == DBSCAN(eps=eps, min_samples=min_samples).fit(X).labels_).all()
+    for eps in (0.05, 0.1, 0.15, 0.2) for min_samples in (3, 5, 10, 20)
+)
+
+
+# In[174]:
+
+
+dbscan_sweep.sweep(eps_values=(0.05, 0.1, 0.15, 0.2),
+                   min_samples_values=(3, 5, 10, 20))
+
+
+# And we can predict the cluster of new instances, just like earlier:
+
+# In[175]:
+
+
+X_new = np.array([[-0.5, 0], [0, 0.5], [1, -0.1], [2, 1]])
+dbscan_sweep.predict(X_new, eps=0.2)
+
+
+# Now let's compare the time it takes to run a sweep over 4 × 4 combinations on a larger dataset. The single neighbor search is where most of the time goes, so the sweep is several times faster than fitting one `DBSCAN` model per combination, and the gap grows with the number of combinations:
+
+# In[176]:
+
+
+X_large, _ = make_moons(n_samples=200_000, noise=0.05, random_state=42)
+eps_values, min_samples_values = (0.0025, 0.005, 0.0075, 0.01), (3, 5, 10, 20)
+
+
+# In[177]:
+
+
+get_ipython().run_cell_magic('time', '', 'for eps in eps_values:\n    for min_samples in min_samples_values:\n        DBSCAN(eps=eps, min_samples=min_samples).fit(X_large)\n')
+
+
+# In[178]:
+
+
+get_ipython().run_cell_magic('time', '', 'DBSCANSweep(max_eps=max(eps_values)).fit(X_large).sweep(eps_values,\n                                                         min_samples_values)\n')
+
+
+# # Extra Material – Streaming Anomaly Detection
+
+# In the anomaly detection section, we computed the densities of all the instances, then we used `np.percentile()` to find the density threshold. This requires keeping all the densities in memory, and rescoring everything whenever we want a different percentile. On a continuous stream of events, we can instead score the instances batch by batch, and only keep a small _quantile sketch_ of the densities: this is a compact summary of their distribution which lets us estimate any percentile.
+# 
+# Our sketch is a histogram of the log densities with bins of equal width, of which only the non-empty ones are stored. Whenever there are more than `max_bins` non-empty bins, the bin width is doubled and pairs of neighboring bins are merged. This bounds the sketch's size, and each percentile estimate is accurate to within one bin width. Moreover, two sketches can be merged (e.g., if several servers score different parts of the stream): we just merge the bins of the finest sketch until both sketches have the same bin width, then we add their counts.
+
+# In[179]:
+
+
+class QuantileSketch:
+    def __init__(self, max_bins=2048, bin_width=1e-3):
+        self.max_bins = max_bins
+        self.bin_width = bin_width
+        self.bins = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        bins = np.floor(values / self.bin_width).astype(np.int64)
+        self._add(*np.unique(bins, return_counts=True))
+        return self
+
+    def merge(self, other):
+        while self.bin_width < other.bin_width:
+            self._collapse()
+        ratio = round(self.bin_width / other.bin_width)
+        if not np.isclose(ratio * other.bin_width, self.bin_width):
+            raise ValueError("The bin widths must differ by a power of 2")
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._add(other.bins // ratio, other.counts)
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            raise ValueError("The sketch is empty")
+        cumulative_counts = self.counts.cumsum()
+        ranks = np.asarray(q) * self.count
+        idx = np.searchsorted(cumulative_counts, ranks).clip(0, len(self.bins) - 1)
+        fraction = (ranks - cumulative_counts[idx] + self.counts[idx]) / self.counts[idx]
+        values = (self.bins[idx] + fraction) * self.bin_width
+        return values.clip(self.min, self.max)
+
+    def _add(self, bins, counts):
+        all_bins, inverse = np.unique(np.r_[self.bins, bins], return_inverse=True)
+        self.counts = np.bincount(inverse, weights=np.r_[self.counts, counts],
+                                  minlength=len(all_bins)).astype(np.int64)
+        self.bins = all_bins
+        while len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self):
+        self.bin_width *= 2
+        self.bins, inverse = np.unique(self.bins // 2, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=self.counts).astype(np.int64)
+
+
+# Now let's write an anomaly detector which wraps any density model that has a `score_samples()` method (such as a `GaussianMixture`). Its `alerts()` method takes an iterable of batches, and it returns a generator that yields an alert for every instance whose density is below the current threshold. By default, each batch is added to the sketch before its alerts are emitted, and no alert is emitted until the sketch contains at least `min_count` densities. If `update=False`, the threshold is frozen, which is useful once the distribution is known to be stable.
+
+# In[180]:
+
+
+Alert = namedtuple("Alert", ["index", "density", "threshold"])
+
+class StreamingAnomalyDetector:
+    def __init__(self, density_model, percentile=2, max_bins=2048,
+                 bin_width=1e-3):
+        self.density_model = density_model
+        self.percentile = percentile
+        self.sketch_ = QuantileSketch(max_bins=max_bins, bin_width=bin_width)
+
+    def partial_fit(self, X_batch):
+        self.sketch_.update(self.density_model.score_samples(X_batch))
+        return self
+
+    def merge(self, other):
+        self.sketch_.merge(other.sketch_)
+        return self
+
+    def threshold(self, percentile=None):
+        if percentile is None:
+            percentile = self.percentile
+        return self.sketch_.quantile(np.asarray(percentile) / 100)
+
+    def alerts(self, batches, update=True, min_count=1000):
+        n_seen = 0
+        for X_batch in batches:
+            densities = self.density_model.score_samples(X_batch)
+            if update:
+                self.sketch_.update(densities)
+            if self.sketch_.count >= min_count:
+                threshold = self.threshold()
+                for idx in np.flatnonzero(densities < threshold):
+                    yield Alert(n_seen + idx, densities[idx], threshold)
+            n_seen += len(X_batch)
+
+
+# Let's train a Gaussian mixture on the same dataset as in the anomaly detection section, and feed its densities to the detector in 10 batches:
+
+# In[181]:
+
+
+X_mixture = np.r_[X1, X2]
+gm_mixture = GaussianMixture(n_components=3, n_init=10, random_state=42)
+gm_mixture.fit(X_mixture)
+detector = StreamingAnomalyDetector(gm_mixture)
+for X_batch in np.array_split(X_mixture, 10):
+    detector.partial_fit(X_batch)
+
+mixture_densities = gm_mixture.score_samples(X_mixture)
+detector.threshold(), np.percentile(mixture_densities, 2)
+
+
+# The thresholds are slightly different because `np.percentile()` interpolates between the two closest densities, while the sketch only knows that the 2% percentile lies in a given bin. However, they both fall between the same two densities, so they flag exactly the same anomalies:
+
+# In[182]:
+
+
+((mixture_densities < detector.threshold())
+ == (mixture_densities < np.percentile(mixture_densities, 2))).all()
+
+
+# The threshold for any other percentile is available instantly, without rescoring:
+
+# In[183]:
+
+
+detector.threshold([1, 2, 5, 50])
+
+
+# Sketches computed on separate parts of the data can be merged:
+
+# In[184]:
+
+
+first_half, second_half = np.array_split(X_mixture, 2)
+merged_detector = StreamingAnomalyDetector(gm_mixture).partial_fit(first_half)
+merged_detector.merge(StreamingAnomalyDetector(gm_mixture).partial_fit(second_half))
+merged_detector.threshold()
+
+
+# Now let's simulate a continuous stream of events generated by the Gaussian mixture itself, and measure the throughput. Since the sketch only contains a couple thousand bins at most, the bottleneck is the call to `score_samples()`:
+
+# In[185]:
+
+
+def event_stream(density_model, n_batches, batch_size=10_000, seed=42):
+    rng = np.random.default_rng(seed)
+    for _ in range(n_batches):
+        X_batch, _ = density_model.sample(batch_size)
+        yield X_batch[rng.permutation(batch_size)]
+
+stream_detector = StreamingAnomalyDetector(gm_mixture)
+
+
+# In[186]:
+
+
+get_ipython().run_cell_magic('time', '', 'alerts = list(stream_detector.alerts(event_stream(gm_mixture, n_batches=100)))\n')
+
+
+# In[187]:
+
+
+len(alerts) / stream_detector.sketch_.count, len(stream_detector.sketch_.bins)
+
+
+# In[188]:
+
+
+alerts[:3]
+
+
+# # Extra Material – Computing Reconstruction Errors in Blocks
+
+# The `reconstruction_errors()` function from exercise 13 builds `X_pca`, then `X_reconstructed`, then the squared differences, for the whole dataset at once: that's three full-size copies (in 64-bit floats, unless `X` uses 32-bit floats). To score tens of millions of instances, we can process the dataset block by block instead, in 32-bit floats, using a thread pool (NumPy releases the GIL during matrix multiplications). Moreover, we don't even need to reconstruct the instances: since the rows of `pca.components_` (let's call this matrix **W**) are orthonormal, the squared reconstruction error of a centered instance **x** is simply ‖**x**‖² − ‖**x** **W**ᵀ‖². This only requires the projection, which we need anyway if we want to compute densities using a `GaussianMixture` trained on the reduced data: if you pass one as the `density_model` argument, the function also returns its `score_samples()` for every instance, in the same pass. Lastly, models that have no orthonormal `components_` attribute (e.g., `KernelPCA` with `fit_inverse_transform=True`) fall back to a blockwise `transform()` + `inverse_transform()`.
+# 
+# Note that the subtraction loses some precision when the reconstruction errors are tiny compared to the instances' squared norms, which is why we clip the result to 0. For anomaly detection, this does not matter since we care about the large errors.
+
+# In[189]:
+
+
+def blockwise_reconstruction_errors(pca, X, density_model=None,
+                                    block_size=10_000, dtype=np.float32,
+                                    n_threads=4):
+    errors = np.empty(len(X), dtype=dtype)
+    densities = None if density_model is None else np.empty(len(X))
+    orthonormal = hasattr(pca, "components_") and hasattr(pca, "mean_")
+    if orthonormal:
+        components_T = pca.components_.T.astype(dtype)
+        mean = pca.mean_.astype(dtype)
+        if getattr(pca, "whiten", False):
+            scale = np.sqrt(pca.explained_variance_).astype(dtype)
+
+    def score_block(start):
+        X_block = np.asarray(X[start:start + block_size], dtype=dtype)
+        if orthonormal:
+            X_centered = X_block - mean
+            X_proj = X_centered @ components_T
+            squared_errors = (np.einsum("ij,ij->i", X_centered, X_centered)
+                              - np.einsum("ij,ij->i", X_proj, X_proj))
+            errors[start:start + block_size] = (
+                squared_errors.clip(0) / X_block.shape[1])
+            if getattr(pca, "whiten", False):
+                X_proj /= scale
+        else:
+            X_proj = pca.transform(X_block)
+            X_reconstructed = pca.inverse_transform(X_proj)
+            errors[start:start + block_size] = np.square(
+                X_reconstructed - X_block).mean(axis=-1)
+        if density_model is not None:
+            densities[start:start + block_size] = density_model.score_samples(
+                X_proj)
+
+    with ThreadPoolExecutor(n_threads) as executor:
+        list(executor.map(score_block, range(0, len(X), block_size)))
+    return errors if density_model is None else (errors, densities)
+
+
+# Let's check that we get the same results as earlier, for the reconstruction errors and for the densities computed by the Gaussian mixture model from exercise 12 (up to the precision of 32-bit floats, since the blocks are processed in 32-bit floats):
+
+# In[190]:
+
+
+errors, densities = blockwise_reconstruction_errors(pca, X_train, gm,
+                                                    block_size=64)
+(np.allclose(errors, reconstruction_errors(pca, X_train), rtol=1e-3)
+ and np.allclose(densities, gm.score_samples(X_train_pca), rtol=1e-3))
+
+
+# In[191]:
+
+
+blockwise_reconstruction_errors(pca, X_bad_faces).mean()
+
+
+# Now let's compare the time and peak memory usage on a larger dataset of 20,000 faces (in 32-bit floats, this dataset already uses over 300 MB of RAM):
+
+# In[192]:
+
+
+import tracemalloc
+
+def peak_memory_mb(func, *args, **kwargs):
+    tracemalloc.start()
+    func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 2**20
+
+X_many_faces = np.tile(X_train.astype(np.float32), (84, 1))[:20_000]
+
+
+# In[193]:
+
+
+get_ipython().run_line_magic('timeit', '-n 1 -r 1 reconstruction_errors(pca, X_many_faces)')
+get_ipython().run_line_magic('timeit', '-n 1 -r 1 blockwise_reconstruction_errors(pca, X_many_faces)')
+
+
+# In[194]:
+
+
+(peak_memory_mb(reconstruction_errors, pca, X_many_faces),
+ peak_memory_mb(blockwise_reconstruction_errors, pca, X_many_faces,
+                block_size=1_000))
+
+
+# Since each block is read separately, `X` can also be a `np.memmap`, so the dataset doesn't even need to fit in memory.
+
+# # Extra Material – Caching Cluster Features for Exercise 11
+
+# In exercise 11, each iteration of the `k_range` loop trains a new K-Means model on the PCA-reduced data, computes the distances to the centroids, and trains a Random Forest on them, and we repeat the whole process to evaluate the extended features built with `np.c_[]`. If we want to try other classifiers, other random seeds, or just rerun the notebook, all the K-Means models must be trained again. Let's write a small feature store which saves the features on disk for each (_k_, seed) pair, and loads them as memory-mapped arrays:
+# 
+# * the PCA projections of each split (train, validation and test) are saved just once, as 32-bit floats, and for each (_k_, seed) pair we only save the _k_ distances to the centroids for each split. The cluster features are just these distances, and the extended features are built on demand by stacking the PCA projections and the distances with `np.hstack()`, so the PCA projections are not duplicated on disk for every value of _k_ (they are saved when the store is created, before any worker process needs them);
+# * the files live in a directory whose name is a hash of the PCA projections, so the cache is automatically invalidated if the data or the PCA model changes;
+# * since the features are memory-mapped, joblib passes them by reference to its worker processes (instead of copying them), so we can train the classifiers for all values of _k_ in parallel.
+
+# In[195]:
+
+
+from joblib import hash as joblib_hash
+
+class ClusterFeatureStore:
+    def __init__(self, X_splits_pca, train_split="train",
+                 cache_dir=Path("my_cluster_features")):
+        self.X_splits_pca = {split: np.asarray(X, dtype=np.float32)
+                             for split, X in X_splits_pca.items()}
+        self.train_split = train_split
+        self.cache_dir = cache_dir / joblib_hash(self.X_splits_pca)
+        for split, X_pca in self.X_splits_pca.items():
+            if not self._pca_path(split).exists():
+                self._save(self._pca_path(split), X_pca)
+
+    def _path(self, k, seed, split):
+        return self.cache_dir / f"k{k}_seed{seed}_{split}.npy"
+
+    def _pca_path(self, split):
+        return self.cache_dir / f"pca_{split}.npy"
+
+    def _save(self, path, features):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp.npy")
+        np.save(tmp_path, features.astype(np.float32))
+        tmp_path.replace(path)  # atomic
+
+    def _build(self, k, seed):
+        kmeans = KMeans(n_clusters=k, random_state=seed)
+        kmeans.fit(self.X_splits_pca[self.train_split])
+        for split, X_pca in self.X_splits_pca.items():
+            self._save(self._path(k, seed, split), kmeans.transform(X_pca))
+
+    def pca_features(self, split="train"):
+        return np.load(self._pca_path(split), mmap_mode="r")
+
+    def cluster_features(self, k, seed=42, split="train"):
+        if not self._path(k, seed, split).exists():
+            self._build(k, seed)
+        return np.load(self._path(k, seed, split), mmap_mode="r")
+
+    def extended_features(self, k, seed=42, split="train"):
+        return np.hstack([self.pca_features(split),
+                          self.cluster_features(k, seed, split)])
+
+
+# Now let's write a function which trains and evaluates one classifier per value of _k_, in parallel. The K-Means models are trained (in the worker processes) only if their features are not already in the store:
+
+# In[196]:
+
+
+from sklearn.base import clone
+
+def evaluate_cluster_features(store, classifier, y_train, y_valid, k_range,
+                              seed=42, extended=False, n_jobs=-1):
+    def fit_and_score(k):
+        get_features = (store.extended_features if extended
+                        else store.cluster_features)
+        model = clone(classifier).fit(get_features(k, seed, "train"), y_train)
+        return model.score(get_features(k, seed, "valid"), y_valid)
+
+    scores = Parallel(n_jobs=n_jobs)(delayed(fit_and_score)(k)
+                                     for k in k_range)
+    return pd.Series(scores, index=pd.Index(k_range, name="k"))
+
+
+# In[197]:
+
+
+store = ClusterFeatureStore({"train": X_train_pca, "valid": X_valid_pca,
+                             "test": X_test_pca})
+forest = RandomForestClassifier(n_estimators=150, random_state=42)
+
+
+# The first run trains all the K-Means models and fills the store:
+
+# In[198]:
+
+
+get_ipython().run_line_magic('time', 'cluster_scores = evaluate_cluster_features(store, forest, y_train, y_valid, k_range)')
+
+
+# The second run, on the extended features, reuses the cached K-Means features, so it only trains the Random Forests:
+
+# In[199]:
+
+
+get_ipython().run_line_magic('time', 'extended_scores = evaluate_cluster_features(store, forest, y_train, y_valid, k_range, extended=True)')
+
+
+# In[200]:
+
+
+pd.DataFrame({"cluster_features": cluster_scores,
+              "extended_features": extended_scores}).T.round(3)
+
+
+# The K-Means models and the Random Forests use the same random seeds as in exercise 11, so the scores are the same as earlier. For example, for _k_ = 5:
+
+# In[201]:
+
+
+pipeline = make_pipeline(
+    KMeans(n_clusters=5, random_state=42),
+    RandomForestClassifier(n_estimators=150, random_state=42)
+)
+pipeline.fit(X_train_pca, y_train)
+pipeline.score(X_valid_pca, y_valid), cluster_scores[5]
+
+
 # In[ ]:
 
 
@@ -1522,6 +1522,144 @@ model.evaluate(X_test, y_test)
 get_ipython().run_line_magic('tensorboard', '--logdir=./my_mnist_logs')
 
 
+# # Extra Material – Running Keras Tuner Trials in Parallel
+
+# The tuners above run one trial at a time, in a single process. TensorFlow can use several cores for each trial, but small models like ours cannot keep many cores busy, so most of a many-core CPU sits idle. Keras Tuner supports distributed tuning (as we will see in Chapter 19): a _chief_ process runs the oracle, and it hands out trials to _worker_ processes, which report their metrics back to it after every epoch (this is what allows Hyperband to stop unpromising trials early). The chief and the workers are configured using the `KERASTUNER_TUNER_ID`, `KERASTUNER_ORACLE_IP`, and `KERASTUNER_ORACLE_PORT` environment variables, and they can perfectly well all run on the same machine.
+# 
+# Let's write a small script that runs either the chief or a worker. It pins the process to the cores listed in the `MY_TUNER_CORES` environment variable (Linux only) and sets TensorFlow's number of intra-op threads accordingly, so the workers don't fight over the same cores. Then it loads the tuner's specification (the tuner class, the hypermodel, and the arguments for the tuner and for its `search()` method), creates the tuner and runs the search:
+
+# In[130]:
+
+
+get_ipython().run_cell_magic('writefile', 'my_parallel_tuner_task.py', '\nimport os\nimport sys\nfrom pathlib import Path\n\ncores = os.environ.get("MY_TUNER_CORES")\nif cores:\n    cores = [int(core) for core in cores.split(",")]\n    os.sched_setaffinity(0, cores)  # must be done before TF starts its threads\n    os.environ["OMP_NUM_THREADS"] = str(len(cores))\n\nimport tensorflow as tf\nimport cloudpickle\n\nif cores:\n    tf.config.threading.set_intra_op_parallelism_threads(len(cores))\n    tf.config.threading.set_inter_op_parallelism_threads(1)\n\nspec = cloudpickle.loads(Path(sys.argv[1]).read_bytes())\ntuner = spec["tuner_class"](spec["hypermodel"], **spec["tuner_kwargs"])\ntuner.search(*spec["search_args"], **spec["search_kwargs"])\n')
+
+
+# Now let's write the `parallel_search()` function which serializes the specification using `cloudpickle` (which is installed along with joblib, and which can serialize functions and classes defined in a notebook, such as `build_model()` and `MyClassificationHyperModel`, so we can use them unchanged), then starts the chief and one worker per group of cores, and monitors them:
+# 
+# * if a worker crashes, it is restarted with the same tuner ID, and the oracle gives it back the trial it was working on;
+# * if the chief crashes, you can call `parallel_search()` again with `resume=True`: the oracle will reload its state from the project directory, and the trials that were already completed will not run again.
+# * if `overwrite=True` (and `resume=False`), the project directory is deleted before any process starts, and all the processes are then created with `overwrite=False`: if the chief deleted the project directory itself, it might do so while the workers are already reading or writing it.
+# 
+# Once the search is over, the function returns a regular tuner which reloads the search results from the project directory, so you can call `get_best_models()`, `get_best_hyperparameters()`, and so on, just like earlier. Each process writes its logs to a file in the `<project_name>_parallel` directory.
+
+# In[131]:
+
+
+import os
+import shutil
+import subprocess
+import time
+
+import cloudpickle
+
+def parallel_search(tuner_class, hypermodel, search_args, search_kwargs,
+                    n_workers=None, cores_per_worker=2, port=8000,
+                    max_restarts=3, resume=False, **tuner_kwargs):
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    if n_workers is None:
+        n_workers = max(1, len(cores) // cores_per_worker)
+    # more workers than cores => the extra workers are not pinned
+    worker_cores = {f"worker{index}": core_group.tolist() or None
+                    for index, core_group
+                    in enumerate(np.array_split(cores, n_workers))}
+
+    project_dir = (Path(tuner_kwargs.get("directory", "."))
+                   / tuner_kwargs.get("project_name", "untitled_project"))
+    if tuner_kwargs.pop("overwrite", False) and not resume:
+        shutil.rmtree(project_dir, ignore_errors=True)  # before any process starts
+    tuner_kwargs["overwrite"] = False
+    run_dir = project_dir.with_name(f"{project_dir.name}_parallel")
+    run_dir.mkdir(parents=True, exist_ok=True)
+    spec_path = run_dir / "spec.pkl"
+    spec_path.write_bytes(cloudpickle.dumps({
+        "tuner_class": tuner_class, "hypermodel": hypermodel,
+        "tuner_kwargs": tuner_kwargs, "search_args": search_args,
+        "search_kwargs": search_kwargs
+    }))
+
+    def launch(tuner_id, cores=None):
+        env = dict(os.environ, KERASTUNER_TUNER_ID=tuner_id,
+                   KERASTUNER_ORACLE_IP="127.0.0.1",
+                   KERASTUNER_ORACLE_PORT=str(port), CUDA_VISIBLE_DEVICES="")
+        if cores is not None:
+            env["MY_TUNER_CORES"] = ",".join(str(core) for core in cores)
+        with open(run_dir / f"{tuner_id}.log", "a") as log:
+            return subprocess.Popen(
+                [sys.executable, "my_parallel_tuner_task.py", str(spec_path)],
+                env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    chief = launch("chief")
+    workers = {tuner_id: launch(tuner_id, cores)
+               for tuner_id, cores in worker_cores.items()}
+    n_restarts = dict.fromkeys(workers, 0)
+    try:
+        while chief.poll() is None:
+            for tuner_id, worker in workers.items():
+                if worker.poll() not in (None, 0):
+                    if n_restarts[tuner_id] >= max_restarts:
+                        raise RuntimeError(f"{tuner_id} crashed too many times, "
+                                           f"see {run_dir / tuner_id}.log")
+                    print(f"{tuner_id} crashed, restarting it")
+                    n_restarts[tuner_id] += 1
+                    workers[tuner_id] = launch(tuner_id, worker_cores[tuner_id])
+            time.sleep(1)
+    finally:
+        for process in [chief, *workers.values()]:
+            if process.poll() is None:
+                process.terminate()
+
+    if chief.returncode != 0:
+        raise RuntimeError(f"The chief crashed, see {run_dir / 'chief.log'}. "
+                           "Call parallel_search() with resume=True to resume.")
+    return tuner_class(hypermodel, **tuner_kwargs)
+
+
+# Let's run the same random search as earlier on the Fashion MNIST dataset, but with 10 trials instead of 5. The 4 workers run 4 trials at a time, so on a machine with 8 cores or more, this should take about as long as 3 sequential trials:
+
+# In[132]:
+
+
+(X_train_full, y_train_full), (X_test, y_test) = fashion_mnist
+X_train, y_train = X_train_full[:-5000], y_train_full[:-5000]
+X_valid, y_valid = X_train_full[-5000:], y_train_full[-5000:]
+
+
+# In[133]:
+
+
+parallel_random_search_tuner = parallel_search(
+    kt.RandomSearch, build_model, search_args=(X_train, y_train),
+    search_kwargs=dict(epochs=10, validation_data=(X_valid, y_valid)),
+    n_workers=4, objective="val_accuracy", max_trials=10, overwrite=True,
+    directory="my_fashion_mnist", project_name="my_parallel_rnd_search",
+    seed=42)
+
+
+# In[134]:
+
+
+parallel_random_search_tuner.get_best_hyperparameters()[0].values
+
+
+# The same function works with Hyperband and with our `MyClassificationHyperModel`. The early stopping callback is serialized along with the other `search()` arguments, so each worker gets its own copy:
+
+# In[135]:
+
+
+parallel_hyperband_tuner = parallel_search(
+    kt.Hyperband, MyClassificationHyperModel(),
+    search_args=(X_train, y_train),
+    search_kwargs=dict(epochs=10, validation_data=(X_valid, y_valid),
+                       callbacks=[tf.keras.callbacks.EarlyStopping(patience=2)]),
+    objective="val_accuracy", seed=42, max_epochs=10, factor=3,
+    hyperband_iterations=2, overwrite=True, directory="my_fashion_mnist",
+    project_name="my_parallel_hyperband")
+parallel_hyperband_tuner.oracle.get_best_trials(num_trials=1)[0].summary()
+
+
 # In[ ]:
 
 
@@ -1852,3 +1852,784 @@ history = model.fit(X_train_scaled, y_train, epochs=n_epochs, batch_size=batch_s
 
 
 # One cycle allowed us to train the model in just 15 epochs, each taking only 2 seconds (thanks to the larger batch size). This is several times faster than the fastest model we trained so far. Moreover, we improved the model's performance (from 50.7% to 52.0%).
+
+# # Extra Material – In-Graph Learning Rate Schedules
+
+# The `ExponentialLearningRate`, `ExponentialDecay`, and `OneCycleScheduler` callbacks all update the learning rate from Python, by calling `K.set_value()` before or after every batch. This requires a round trip between Python and the TensorFlow runtime at each training step, which is costly for small models, and it does not play well with the `steps_per_execution` argument of the `compile()` method: when it is greater than 1, Keras runs several training steps per call to the compiled function, and it only calls the batch callbacks once per call, so the learning rate would only get updated every `steps_per_execution` steps.
+# 
+# Instead, we can implement these schedules as `LearningRateSchedule` subclasses: the optimizer calls the schedule with its current step (`optimizer.iterations`) inside the compiled training step, so the learning rate is computed by TensorFlow without ever going back to Python. Each schedule below produces the same learning rates as the corresponding callback:
+# 
+# * `ExponentialLearningRate` multiplies the learning rate by `factor` after each batch, so batch #_i_ (counting from 0 since the start of training) uses `initial_learning_rate * factor ** i`.
+# * `ExponentialDecay` multiplies it by `0.1 ** (1 / n_steps)` _before_ each batch, so batch #_i_ uses `initial_learning_rate * 0.1 ** ((i + 1) / n_steps)`. Note that this is one step ahead of Keras's own `ExponentialDecay` schedule.
+# * `OneCycleScheduler` uses three linear segments, which we compute for all steps using `tf.where()`.
+# 
+# The schedules also work on a whole vector of steps at once, which is handy to plot them. And they implement `get_config()`, so the models that use them can be saved and loaded (you will need to pass them in the `custom_objects` argument when loading the model).
+
+# In[136]:
+
+
+class ExponentialLearningRateSchedule(
+        tf.keras.optimizers.schedules.LearningRateSchedule):
+    def __init__(self, initial_learning_rate, factor):
+        self.initial_learning_rate = initial_learning_rate
+        self.factor = factor
+
+    def __call__(self, step):
+        step = tf.cast(step, tf.float32)
+        return self.initial_learning_rate * self.factor ** step
+
+    def get_config(self):
+        return {"initial_learning_rate": self.initial_learning_rate,
+                "factor": self.factor}
+
+class ExponentialDecaySchedule(
+        tf.keras.optimizers.schedules.LearningRateSchedule):
+    def __init__(self, initial_learning_rate, n_steps=40_000):
+        self.initial_learning_rate = initial_learning_rate
+        self.n_steps = n_steps
+
+    def __call__(self, step):
+        step = tf.cast(step, tf.float32)
+        return self.initial_learning_rate * 0.1 ** ((step + 1) / self.n_steps)
+
+    def get_config(self):
+        return {"initial_learning_rate": self.initial_learning_rate,
+                "n_steps": self.n_steps}
+
+class OneCycleSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
+    def __init__(self, iterations, max_lr=1e-3, start_lr=None,
+                 last_iterations=None, last_lr=None):
+        self.iterations = iterations
+        self.max_lr = max_lr
+        self.start_lr = start_lr or max_lr / 10
+        self.last_iterations = last_iterations or iterations // 10 + 1
+        self.half_iteration = (iterations - self.last_iterations) // 2
+        self.last_lr = last_lr or self.start_lr / 1000
+
+    def _interpolate(self, step, iter1, iter2, lr1, lr2):
+        return (lr2 - lr1) * (step - iter1) / (iter2 - iter1) + lr1
+
+    def __call__(self, step):
+        step = tf.cast(step, tf.float32)
+        half = self.half_iteration
+        return tf.where(
+            step < half,
+            self._interpolate(step, 0, half, self.start_lr, self.max_lr),
+            tf.where(
+                step < 2 * half,
+                self._interpolate(step, half, 2 * half, self.max_lr,
+                                  self.start_lr),
+                self._interpolate(step, 2 * half, self.iterations,
+                                  self.start_lr, self.last_lr)))
+
+    def get_config(self):
+        return {"iterations": self.iterations, "max_lr": self.max_lr,
+                "start_lr": self.start_lr,
+                "last_iterations": self.last_iterations,
+                "last_lr": self.last_lr}
+
+
+# Let's check that the schedules produce the same learning rates as the callbacks. For this, we don't need to train anything: we can just attach each callback to a compiled model, call its batch methods manually, and read the learning rate that would be used for each step:
+
+# In[137]:
+
+
+def callback_learning_rates(callback, n_steps, initial_learning_rate=0.01):
+    model = build_model()
+    model.compile(loss="sparse_categorical_crossentropy",
+                  optimizer=tf.keras.optimizers.SGD(
+                      learning_rate=initial_learning_rate))
+    callback.set_model(model)
+    callback.on_epoch_begin(0)
+    rates = []
+    for batch in range(n_steps):
+        callback.on_batch_begin(batch, logs={})
+        rates.append(K.get_value(model.optimizer.learning_rate))
+        callback.on_batch_end(batch, logs={"loss": 0.0})
+    return np.array(rates)
+
+n_steps = 1000
+for callback, schedule in [
+    (ExponentialLearningRate(factor=1.005),
+     ExponentialLearningRateSchedule(0.01, factor=1.005)),
+    (ExponentialDecay(n_steps=n_steps),
+     ExponentialDecaySchedule(0.01, n_steps=n_steps)),
+    (OneCycleScheduler(n_steps, max_lr=0.1),
+     OneCycleSchedule(n_steps, max_lr=0.1)),
+]:
+    print(type(schedule).__name__, np.allclose(
+        callback_learning_rates(callback, n_steps), schedule(np.arange(n_steps)),
+        rtol=1e-4))
+
+
+# The values may not be bit-for-bit identical, since the callbacks accumulate floating point errors by repeatedly multiplying the learning rate, but the differences are negligible.
+# 
+# Now let's measure the training speed (in steps per second) of a small model. The exercise above replaced the Fashion MNIST dataset with CIFAR10, so let's load it again. We time the second epoch, to exclude the time it takes to build the training function during the first epoch:
+
+# In[138]:
+
+
+(X_train_full, y_train_full), (X_test, y_test) = fashion_mnist
+X_train, y_train = X_train_full[:-5000], y_train_full[:-5000]
+X_valid, y_valid = X_train_full[-5000:], y_train_full[-5000:]
+X_train, X_valid, X_test = X_train / 255, X_valid / 255, X_test / 255
+
+
+# In[139]:
+
+
+import time
+
+class EpochTimer(tf.keras.callbacks.Callback):
+    def on_train_begin(self, logs=None):
+        self.epoch_times = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch_times.append(time.perf_counter() - self.epoch_start)
+
+def training_steps_per_second(learning_rate, callbacks=(), batch_size=32,
+                              steps_per_execution=1):
+    model = build_model()
+    model.compile(loss="sparse_categorical_crossentropy",
+                  optimizer=tf.keras.optimizers.SGD(learning_rate=learning_rate),
+                  steps_per_execution=steps_per_execution)
+    epoch_timer = EpochTimer()
+    model.fit(X_train, y_train, epochs=2, batch_size=batch_size, verbose=0,
+              callbacks=[*callbacks, epoch_timer])
+    return math.ceil(len(X_train) / batch_size) / epoch_timer.epoch_times[-1]
+
+
+# In[140]:
+
+
+n_steps = 25 * math.ceil(len(X_train) / 32)
+speeds = {
+    "OneCycleScheduler callback": training_steps_per_second(
+        0.01, callbacks=[OneCycleScheduler(n_steps, max_lr=0.1)]),
+    "OneCycleSchedule": training_steps_per_second(
+        OneCycleSchedule(n_steps, max_lr=0.1)),
+    "OneCycleSchedule, steps_per_execution=50": training_steps_per_second(
+        OneCycleSchedule(n_steps, max_lr=0.1), steps_per_execution=50),
+}
+for name, speed in speeds.items():
+    print(f"{name}: {speed:.0f} steps/s")
+
+
+# The in-graph schedule removes the per-batch Python callback, and it lets us use `steps_per_execution` safely, which removes most of the remaining per-step overhead. The larger the model, the smaller the speedup, since the step itself takes more time: this optimization matters most for small models like this one.
+
+# # Extra Material – A Faster Learning Rate Finder
+
+# The `find_learning_rate()` function always trains the model for a full epoch (or more) on the whole training set, even long after the loss has exploded, and it updates the learning rate from Python at every step. Let's write a faster version:
+# 
+# * it can train on a stratified subsample of the training set (the loss curve only needs a few hundred steps to take shape);
+# * it grows the learning rate using the in-graph `ExponentialLearningRateSchedule`;
+# * it computes an exponential moving average of the batch losses (with bias correction, since the average starts at 0), and it stops training as soon as this smoothed loss exceeds `divergence_factor` times its minimum value so far;
+# * it trains a clone of the model (with a fresh copy of the optimizer), built from an in-memory copy of the weights: the original model and its optimizer are never modified, so there's nothing to save or restore;
+# * it returns the learning rates, the batch losses, the smoothed losses, and a suggested maximum learning rate for 1cycle: the learning rate at which the smoothed loss was the lowest, divided by `safety_factor`.
+# 
+# Note that `find_learning_rate()` used the instantaneous loss, which is noisy, so its curve is bumpier than the smoothed curve.
+
+# In[141]:
+
+
+from collections import namedtuple
+from sklearn.model_selection import train_test_split
+
+LRFinderResult = namedtuple("LRFinderResult", ["rates", "losses",
+                                               "smoothed_losses",
+                                               "suggested_max_lr"])
+
+class LossDivergenceStopping(tf.keras.callbacks.Callback):
+    def __init__(self, min_rate, factor, divergence_factor=4, smoothing=0.98):
+        super().__init__()
+        self.min_rate = min_rate
+        self.factor = factor
+        self.divergence_factor = divergence_factor
+        self.smoothing = smoothing
+        self.rates = []
+        self.losses = []
+        self.smoothed_losses = []
+        self.avg_loss = 0
+        self.min_smoothed_loss = np.inf
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.sum_of_epoch_losses = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        new_sum_of_epoch_losses = logs["loss"] * (batch + 1)
+        batch_loss = new_sum_of_epoch_losses - self.sum_of_epoch_losses
+        self.sum_of_epoch_losses = new_sum_of_epoch_losses
+        step = len(self.losses)
+        self.rates.append(self.min_rate * self.factor ** step)
+        self.losses.append(batch_loss)
+        self.avg_loss = (self.smoothing * self.avg_loss
+                         + (1 - self.smoothing) * batch_loss)
+        smoothed_loss = self.avg_loss / (1 - self.smoothing ** (step + 1))
+        self.smoothed_losses.append(smoothed_loss)
+        self.min_smoothed_loss = min(self.min_smoothed_loss, smoothed_loss)
+        if (not np.isfinite(smoothed_loss) or smoothed_loss
+                > self.divergence_factor * self.min_smoothed_loss):
+            self.model.stop_training = True
+
+def fast_find_learning_rate(model, X, y, epochs=1, batch_size=32,
+                            min_rate=1e-4, max_rate=1, subsample_size=None,
+                            divergence_factor=4, smoothing=0.98,
+                            safety_factor=2, random_state=42):
+    if subsample_size is not None and subsample_size < len(X):
+        X, _, y, _ = train_test_split(X, y, train_size=subsample_size,
+                                      stratify=y, random_state=random_state)
+    iterations = math.ceil(len(X) / batch_size) * epochs
+    factor = (max_rate / min_rate) ** (1 / iterations)
+
+    model_clone = tf.keras.models.clone_model(model)
+    model_clone.set_weights(model.get_weights())
+    optimizer_config = model.optimizer.get_config()
+    optimizer_config["learning_rate"] = ExponentialLearningRateSchedule(
+        min_rate, factor)
+    model_clone.compile(loss=model.loss,
+                        optimizer=type(model.optimizer).from_config(
+                            optimizer_config))
+    divergence_stopping = LossDivergenceStopping(min_rate, factor,
+                                                 divergence_factor, smoothing)
+    model_clone.fit(X, y, epochs=epochs, batch_size=batch_size, verbose=0,
+                    callbacks=[divergence_stopping])
+
+    rates = np.array(divergence_stopping.rates)
+    smoothed_losses = np.array(divergence_stopping.smoothed_losses)
+    suggested_max_lr = rates[np.nanargmin(smoothed_losses)] / safety_factor
+    return LRFinderResult(rates, np.array(divergence_stopping.losses),
+                          smoothed_losses, suggested_max_lr)
+
+
+# Let's compare it with `find_learning_rate()` on the same Fashion MNIST model as earlier. The fast version trains on 10,000 instances only, and it stops when the loss diverges:
+
+# In[142]:
+
+
+model = build_model()
+model.compile(loss="sparse_categorical_crossentropy",
+              optimizer=tf.keras.optimizers.SGD(learning_rate=0.001),
+              metrics=["accuracy"])
+batch_size = 128
+
+
+# In[143]:
+
+
+get_ipython().run_line_magic('time', 'rates, losses = find_learning_rate(model, X_train, y_train, epochs=1, batch_size=batch_size)')
+
+
+# In[144]:
+
+
+get_ipython().run_line_magic('time', 'lr_finder_result = fast_find_learning_rate(model, X_train, y_train, batch_size=batch_size, subsample_size=10_000)')
+
+
+# In[145]:
+
+
+plt.figure(figsize=(10, 4))
+plt.subplot(121)
+plot_lr_vs_loss(rates, losses)
+plt.title("find_learning_rate()")
+plt.subplot(122)
+plot_lr_vs_loss(lr_finder_result.rates, lr_finder_result.smoothed_losses)
+plt.axvline(lr_finder_result.suggested_max_lr, color="r", linestyle="--")
+plt.title("fast_find_learning_rate()")
+plt.show()
+
+
+# Since the subsample is smaller, each step increases the learning rate by a larger factor, so the fast version covers the same range of learning rates in fewer steps. The suggested learning rate (the dashed red line) can be plugged directly into the 1cycle schedule:
+
+# In[146]:
+
+
+lr_finder_result.suggested_max_lr
+
+
+# In[147]:
+
+
+n_epochs = 25
+onecycle_schedule = OneCycleSchedule(
+    math.ceil(len(X_train) / batch_size) * n_epochs,
+    max_lr=lr_finder_result.suggested_max_lr)
+model.compile(loss="sparse_categorical_crossentropy",
+              optimizer=tf.keras.optimizers.SGD(learning_rate=onecycle_schedule),
+              metrics=["accuracy"])
+history = model.fit(X_train, y_train, epochs=n_epochs, batch_size=batch_size,
+                    validation_data=(X_valid, y_valid))
+
+
+# # Extra Material – Faster MC Dropout
+
+# The `mc_dropout_predict_probas()` function calls `mc_model.predict(X)` once per sample, and it keeps all the predictions in memory before computing their mean: that's `n_samples` full passes over the data, each with the overhead of a `predict()` call, and `n_samples` × _m_ × 10 probabilities in RAM. Let's write a faster version:
+# 
+# * instead of running the model `n_samples` times, we repeat each batch of inputs `samples_per_call` times along the batch dimension (using `tf.tile()`), so a single call to the model returns `samples_per_call` stochastic predictions for every instance. Each row gets its own dropout mask, since `MCDropout` and `MCAlphaDropout` draw independent noise for every row. Calling the model with `training=False` makes the other layers (e.g., batch normalization) behave just like they do in `predict()`;
+# * the model call is wrapped in a `tf.function`, so it's compiled once for each input shape;
+# * instead of storing all the predictions, we keep running statistics for each instance: the mean and the sum of squared deviations of the predicted probabilities (we merge each chunk's statistics into the running ones using Chan et al.'s parallel variant of Welford's algorithm), plus the mean entropy of the individual predictions.
+# 
+# The function returns the mean probabilities, their standard deviation, the predictive entropy (i.e., the entropy of the mean probabilities, which measures the total uncertainty), and the expected entropy (i.e., the mean entropy of the individual predictions). The difference between the last two is the mutual information between the prediction and the model parameters, which measures the part of the uncertainty that is due to the model (this is what MC Dropout captures).
+
+# In[148]:
+
+
+MCDropoutResult = namedtuple("MCDropoutResult", ["mean", "std",
+                                                 "predictive_entropy",
+                                                 "expected_entropy"])
+
+def entropy(probas, axis=-1, eps=1e-12):
+    return -np.sum(probas * np.log(probas + eps), axis=axis)
+
+def mc_dropout_statistics(mc_model, X, n_samples=10, samples_per_call=10,
+                          batch_size=1024):
+    @tf.function
+    def predict_tiled(X_batch, n_copies):
+        X_tiled = tf.tile(X_batch, [n_copies] + [1] * (len(X_batch.shape) - 1))
+        Y_proba = mc_model(X_tiled, training=False)
+        return tf.reshape(Y_proba, [n_copies, -1, Y_proba.shape[-1]])
+
+    means, stds, expected_entropies = [], [], []
+    for start in range(0, len(X), batch_size):
+        X_batch = tf.constant(X[start:start + batch_size], dtype=tf.float32)
+        count, mean, sum_sq_dev, sum_entropy = 0, 0.0, 0.0, 0.0
+        while count < n_samples:
+            n_copies = min(samples_per_call, n_samples - count)
+            Y_probas = predict_tiled(X_batch, n_copies).numpy()
+            chunk_mean = Y_probas.mean(axis=0)
+            delta = chunk_mean - mean
+            total = count + n_copies
+            sum_sq_dev = (sum_sq_dev + ((Y_probas - chunk_mean) ** 2).sum(axis=0)
+                          + delta ** 2 * count * n_copies / total)
+            mean = mean + delta * n_copies / total
+            sum_entropy = sum_entropy + entropy(Y_probas).sum(axis=0)
+            count = total
+        means.append(mean)
+        stds.append(np.sqrt(sum_sq_dev / count))
+        expected_entropies.append(sum_entropy / count)
+
+    mean = np.concatenate(means)
+    return MCDropoutResult(mean, np.concatenate(stds), entropy(mean),
+                           np.concatenate(expected_entropies))
+
+
+# Note that `n_copies` is passed as a Python integer, so the function gets traced once for each value it takes (at most two, if `n_samples` is not a multiple of `samples_per_call`), plus once for the last batch if it is smaller than the others.
+# 
+# Let's use it with the `MCAlphaDropout` model from exercise 8, and compare it with `mc_dropout_predict_probas()`, using 100 samples. The results are not identical since the dropout masks are random, but the mean probabilities are very close:
+
+# In[149]:
+
+
+tf.random.set_seed(42)
+get_ipython().run_line_magic('time', 'y_proba = mc_dropout_predict_probas(mc_model, X_valid_scaled, n_samples=100)')
+
+
+# In[150]:
+
+
+tf.random.set_seed(42)
+get_ipython().run_line_magic('time', 'mc_result = mc_dropout_statistics(mc_model, X_valid_scaled, n_samples=100)')
+
+
+# In[151]:
+
+
+(np.abs(mc_result.mean - y_proba).max(),
+ (mc_result.mean.argmax(axis=1) == y_proba.argmax(axis=1)).mean())
+
+
+# The standard deviation and the entropies tell us how uncertain the model is for each instance:
+
+# In[152]:
+
+
+mc_result.std[0].round(3)
+
+
+# In[153]:
+
+
+(mc_result.predictive_entropy[:5].round(3),
+ (mc_result.predictive_entropy - mc_result.expected_entropy)[:5].round(3))
+
+
+# Instead of 100 × 5,000 × 10 probabilities (that's 20 MB in 32-bit floats), the function only keeps a few running statistics for each batch of 1,024 instances. The `samples_per_call` argument lets you trade memory for speed: each call processes `batch_size × samples_per_call` rows.
+# 
+# The function works just as well with the `MCDropout` layers we used in the MC Dropout section. Let's rebuild the Fashion MNIST model with dropout from earlier (we only train it for 2 epochs since we just want to check that everything works), then convert its `Dropout` layers to `MCDropout` layers, just like earlier:
+
+# In[154]:
+
+
+tf.random.set_seed(42)
+model = tf.keras.Sequential([
+    tf.keras.layers.Flatten(input_shape=[28, 28]),
+    tf.keras.layers.Dropout(rate=0.2),
+    tf.keras.layers.Dense(100, activation="relu",
+                          kernel_initializer="he_normal"),
+    tf.keras.layers.Dropout(rate=0.2),
+    tf.keras.layers.Dense(100, activation="relu",
+                          kernel_initializer="he_normal"),
+    tf.keras.layers.Dropout(rate=0.2),
+    tf.keras.layers.Dense(10, activation="softmax")
+])
+optimizer = tf.keras.optimizers.SGD(learning_rate=0.01, momentum=0.9)
+model.compile(loss="sparse_categorical_crossentropy", optimizer=optimizer,
+              metrics=["accuracy"])
+history = model.fit(X_train, y_train, epochs=2,
+                    validation_data=(X_valid, y_valid))
+
+
+# In[155]:
+
+
+Dropout = tf.keras.layers.Dropout
+fashion_mc_model = tf.keras.Sequential([
+    MCDropout(layer.rate) if isinstance(layer, Dropout) else layer
+    for layer in model.layers
+])
+fashion_mc_model.set_weights(model.get_weights())
+
+
+# In[156]:
+
+
+tf.random.set_seed(42)
+fashion_mc_result = mc_dropout_statistics(fashion_mc_model, X_test,
+                                          n_samples=100)
+fashion_mc_result.mean[0].round(2), fashion_mc_result.std[0].round(2)
+
+
+# In[157]:
+
+
+(fashion_mc_result.mean.argmax(axis=1) == y_test).mean()
+
+
+# # Extra Material – Benchmarking Optimizers
+
+# In the Faster Optimizers section, we trained the same model with each optimizer and compared their learning curves. But to choose an optimizer in practice, we also care about the time it takes to reach a good model on our hardware, how much memory the optimizer state uses, and how much the results vary from one run to the next. Let's write a small benchmark suite:
+# 
+# * `benchmark_optimizer()` trains the model returned by `build_model(seed)` with the same settings as `build_and_train_model()`, and it records the training time of each epoch (excluding the validation at the end of each epoch, since we want to compare the optimizers), the time per training step (using the median epoch training time, excluding the first epoch which includes building the training function), the optimizer state's size (all its variables except the iteration counter), the final validation loss, and the training time it took to reach `target_val_loss` (measured at the end of each epoch; NaN if never reached);
+# * `benchmark_optimizers()` runs every (optimizer, seed) configuration in a pool of worker processes. Each worker is pinned to its own group of cores (Linux only; if a worker crashes, its replacement is not pinned) and uses that many threads for TensorFlow's operations (these settings must be applied before TensorFlow starts, so the pool is created with fresh processes, which get the settings through an initializer and environment variables). The training data is saved once to disk, and each worker memory-maps it. The queue that hands out the core groups lives in a manager process, which is also started with the "spawn" method rather than forked, since forking a process once TensorFlow is loaded is unsafe;
+# * lastly, the function saves the results of every run, plus a summary (mean and standard deviation across seeds for each optimizer), in JSON and CSV formats.
+
+# In[158]:
+
+
+import json
+import multiprocessing
+import os
+import queue
+
+import pandas as pd
+from joblib.externals.loky import get_reusable_executor
+
+OPTIMIZERS = {
+    "SGD": lambda: tf.keras.optimizers.SGD(learning_rate=0.001),
+    "Momentum": lambda: tf.keras.optimizers.SGD(learning_rate=0.001,
+                                                momentum=0.9),
+    "Nesterov": lambda: tf.keras.optimizers.SGD(learning_rate=0.001,
+                                                momentum=0.9, nesterov=True),
+    "AdaGrad": lambda: tf.keras.optimizers.Adagrad(learning_rate=0.001),
+    "RMSProp": lambda: tf.keras.optimizers.RMSprop(learning_rate=0.001,
+                                                   rho=0.9),
+    "Adam": lambda: tf.keras.optimizers.Adam(learning_rate=0.001, beta_1=0.9,
+                                             beta_2=0.999),
+    "Adamax": lambda: tf.keras.optimizers.Adamax(learning_rate=0.001,
+                                                 beta_1=0.9, beta_2=0.999),
+    "Nadam": lambda: tf.keras.optimizers.Nadam(learning_rate=0.001,
+                                               beta_1=0.9, beta_2=0.999),
+    "AdamW": lambda: tfa.optimizers.AdamW(weight_decay=1e-5,
+                                          learning_rate=0.001, beta_1=0.9,
+                                          beta_2=0.999),
+}
+
+def optimizer_state_bytes(optimizer):
+    variables = optimizer.variables
+    if callable(variables):  # legacy optimizers
+        variables = variables()
+    return sum(np.prod(variable.shape) * variable.dtype.size
+               for variable in variables
+               if variable is not optimizer.iterations)
+
+class TrainingTimer(EpochTimer):
+    # stops the clock when the validation starts, if there is one
+    def on_epoch_begin(self, epoch, logs=None):
+        super().on_epoch_begin(epoch, logs)
+        self.train_end = None
+
+    def on_test_begin(self, logs=None):
+        self.train_end = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        end = self.train_end or time.perf_counter()
+        self.epoch_times.append(end - self.epoch_start)
+
+def benchmark_optimizer(optimizer_name, seed, data_dir, n_epochs=10,
+                        target_val_loss=0.35):
+    X_train, y_train, X_valid, y_valid = [
+        np.load(data_dir / f"{name}.npy", mmap_mode="r")
+        for name in ("X_train", "y_train", "X_valid", "y_valid")]
+    model = build_model(seed)
+    optimizer = OPTIMIZERS[optimizer_name]()
+    model.compile(loss="sparse_categorical_crossentropy", optimizer=optimizer,
+                  metrics=["accuracy"])
+    epoch_timer = TrainingTimer()
+    history = model.fit(X_train, y_train, epochs=n_epochs, verbose=0,
+                        validation_data=(X_valid, y_valid),
+                        callbacks=[epoch_timer])
+    n_steps_per_epoch = math.ceil(len(X_train) / 32)
+    elapsed = np.cumsum(epoch_timer.epoch_times)
+    reached = np.array(history.history["val_loss"]) <= target_val_loss
+    return {
+        "optimizer": optimizer_name,
+        "seed": seed,
+        "time_per_step": np.median(epoch_timer.epoch_times[1:]) / n_steps_per_epoch,
+        "state_bytes": int(optimizer_state_bytes(optimizer)),
+        "final_val_loss": history.history["val_loss"][-1],
+        "final_val_accuracy": history.history["val_accuracy"][-1],
+        "time_to_target": elapsed[reached.argmax()] if reached.any() else np.nan,
+        "val_losses": history.history["val_loss"],
+    }
+
+def pin_worker(core_groups, timeout=1.0):
+    try:
+        cores = core_groups.get(timeout=timeout)
+    except queue.Empty:  # a replacement for a crashed worker: don't pin it
+        return
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+def benchmark_optimizers(optimizer_names=tuple(OPTIMIZERS), seeds=(42, 43, 44),
+                         n_workers=None, cores_per_worker=2,
+                         report_path=Path("my_optimizer_benchmark"), **kwargs):
+    report_path.mkdir(parents=True, exist_ok=True)
+    data_dir = report_path / "data"
+    data_dir.mkdir(exist_ok=True)
+    for name, data in [("X_train", X_train.astype(np.float32)),
+                       ("y_train", y_train), ("X_valid", X_valid.astype(np.float32)),
+                       ("y_valid", y_valid)]:
+        np.save(data_dir / f"{name}.npy", data)
+
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    if n_workers is None:
+        n_workers = max(1, len(cores) // cores_per_worker)
+    n_threads = str(cores_per_worker)
+    with multiprocessing.get_context("spawn").Manager() as manager:
+        core_groups = manager.Queue()
+        for core_group in np.array_split(cores, n_workers):
+            core_groups.put(core_group.tolist() or cores)
+        executor = get_reusable_executor(
+            max_workers=n_workers, reuse=False, initializer=pin_worker,
+            initargs=(core_groups,),
+            env={"TF_NUM_INTRAOP_THREADS": n_threads,
+                 "TF_NUM_INTEROP_THREADS": "1", "OMP_NUM_THREADS": n_threads})
+        try:
+            futures = [executor.submit(benchmark_optimizer, optimizer_name,
+                                       seed, data_dir, **kwargs)
+                       for optimizer_name in optimizer_names
+                       for seed in seeds]
+            runs = pd.DataFrame([future.result() for future in futures])
+        finally:
+            executor.shutdown(wait=True)
+    summary = runs.drop(columns=["seed", "val_losses"]).groupby(
+        "optimizer", sort=False).agg(["mean", "std"])
+    summary.columns = [f"{metric}_{stat}" for metric, stat in summary.columns]
+
+    runs.to_json(report_path / "runs.json", orient="records", indent=2)
+    runs.drop(columns="val_losses").to_csv(report_path / "runs.csv", index=False)
+    summary.to_csv(report_path / "summary.csv")
+    (report_path / "summary.json").write_text(json.dumps(
+        json.loads(summary.reset_index().to_json(orient="records")), indent=2))
+    return runs, summary
+
+
+# **Warning**: the following cell runs 27 training runs of 10 epochs each, so it may take a while, depending on the number of cores on your machine:
+
+# In[159]:
+
+
+runs, summary = benchmark_optimizers()
+summary.sort_values("time_to_target_mean")
+
+
+# Now let's plot the validation loss of every run, with one color per optimizer. This shows the variance across seeds, which the learning curves we plotted earlier did not show:
+
+# In[160]:
+
+
+plt.figure(figsize=(12, 8))
+for color, (optimizer_name, optimizer_runs) in zip(
+        plt.cm.tab10.colors, runs.groupby("optimizer", sort=False)):
+    for index, val_losses in enumerate(optimizer_runs["val_losses"]):
+        plt.plot(val_losses, color=color, linewidth=2,
+                 label=optimizer_name if index == 0 else None)
+plt.grid()
+plt.xlabel("Epochs")
+plt.ylabel("Validation loss")
+plt.legend(loc="upper left")
+plt.axis([0, 9, 0.1, 0.7])
+plt.show()
+
+
+# # Extra Material – Caching the Outputs of Frozen Layers
+
+# When we trained `model_B_on_A` with the reused layers frozen, every epoch still pushed each training and validation instance through all of the frozen layers, even though their outputs never change. We can do better: compute the outputs of the frozen layers once, then train only the remaining layers on these cached features. The `FrozenFeatureTrainer` class below does this automatically:
+# 
+# * its `fit()` method finds the longest prefix of the model's layers that have no trainable weights (e.g., the `Flatten` layer and the frozen `Dense` layers). The prefix stops at the first stochastic layer (e.g., `Dropout`), since its outputs change at every epoch;
+# * it computes the prefix's outputs for the training set and the validation set, and it caches them, either in memory or in memory-mapped files, if you set `cache_dir`. The cache key contains a hash of the prefix's weights, so the cache gets invalidated if they change. The datasets are identified by a hash of their content, computed once per array (the trainer keeps a reference to each array it has hashed, and it reuses the hash when it gets the very same array object again), so don't modify them in place;
+# * it builds a model containing the remaining layers (they are shared with the original model, so training this model trains the original model's layers), it compiles it with the original model's loss and optimizer, and it trains it on the cached features;
+# * if the prefix contains no weights at all (e.g., after we unfreeze the reused layers), it just calls the model's `fit()` method, so it switches back to end-to-end training automatically.
+
+# In[161]:
+
+
+from joblib import hash as joblib_hash
+
+STOCHASTIC_LAYERS = (tf.keras.layers.Dropout, tf.keras.layers.AlphaDropout,
+                     tf.keras.layers.GaussianDropout,
+                     tf.keras.layers.GaussianNoise)
+
+class FrozenFeatureTrainer:
+    def __init__(self, model, metrics=None, cache_dir=None, batch_size=32):
+        self.model = model
+        self.metrics = metrics
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.cache = {}
+        self.fingerprints = []  # list of (array, hash of its content)
+
+    def frozen_prefix_length(self):
+        n_layers = 0
+        for layer in self.model.layers[:-1]:  # keep at least one layer to train
+            if layer.trainable_weights or isinstance(layer, STOCHASTIC_LAYERS):
+                break
+            n_layers += 1
+        prefix_layers = self.model.layers[:n_layers]
+        if not any(layer.weights for layer in prefix_layers):
+            return 0  # nothing worth caching
+        return n_layers
+
+    def fingerprint(self, X):
+        for hashed_X, fingerprint in self.fingerprints:
+            if hashed_X is X:
+                return fingerprint
+        fingerprint = joblib_hash(X)
+        self.fingerprints.append((X, fingerprint))
+        return fingerprint
+
+    def cached_features(self, prefix, X):
+        key = joblib_hash((prefix.get_weights(), self.fingerprint(X)))
+        if key not in self.cache:
+            if self.cache_dir is None:
+                self.cache[key] = prefix.predict(X, batch_size=self.batch_size)
+            else:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                path = self.cache_dir / f"{key}.npy"
+                if not path.exists():
+                    np.save(path, prefix.predict(X, batch_size=self.batch_size))
+                self.cache[key] = np.load(path, mmap_mode="r")
+        return self.cache[key]
+
+    def fit(self, X, y, validation_data=None, **kwargs):
+        batch_size = kwargs.pop("batch_size", self.batch_size)
+        n_frozen = self.frozen_prefix_length()
+        if n_frozen == 0:
+            return self.model.fit(X, y, validation_data=validation_data,
+                                  batch_size=batch_size, **kwargs)
+
+        prefix = tf.keras.Sequential(self.model.layers[:n_frozen])
+        suffix = tf.keras.Sequential(self.model.layers[n_frozen:])
+        suffix.compile(loss=self.model.loss, optimizer=self.model.optimizer,
+                       metrics=self.metrics)
+        if validation_data is not None:
+            X_valid, y_valid = validation_data
+            validation_data = (self.cached_features(prefix, X_valid), y_valid)
+        return suffix.fit(self.cached_features(prefix, X), y,
+                          validation_data=validation_data,
+                          batch_size=batch_size, **kwargs)
+
+
+# Let's use it to run the same training procedure as earlier: 4 epochs with the reused layers frozen, then 16 epochs with all layers trainable:
+
+# In[162]:
+
+
+tf.random.set_seed(42)
+model_A_clone = tf.keras.models.clone_model(model_A)
+model_A_clone.set_weights(model_A.get_weights())
+model_B_on_A = tf.keras.Sequential(model_A_clone.layers[:-1])
+model_B_on_A.add(tf.keras.layers.Dense(1, activation="sigmoid"))
+trainer = FrozenFeatureTrainer(model_B_on_A, metrics=["accuracy"])
+
+for layer in model_B_on_A.layers[:-1]:
+    layer.trainable = False
+
+optimizer = tf.keras.optimizers.SGD(learning_rate=0.001)
+model_B_on_A.compile(loss="binary_crossentropy", optimizer=optimizer,
+                     metrics=["accuracy"])
+
+
+# In[163]:
+
+
+trainer.frozen_prefix_length()
+
+
+# In[164]:
+
+
+history = trainer.fit(X_train_B, y_train_B, epochs=4,
+                      validation_data=(X_valid_B, y_valid_B))
+
+for layer in model_B_on_A.layers[:-1]:
+    layer.trainable = True
+
+optimizer = tf.keras.optimizers.SGD(learning_rate=0.001)
+model_B_on_A.compile(loss="binary_crossentropy", optimizer=optimizer,
+                     metrics=["accuracy"])
+history = trainer.fit(X_train_B, y_train_B, epochs=16,
+                      validation_data=(X_valid_B, y_valid_B))
+
+
+# In[165]:
+
+
+model_B_on_A.evaluate(X_test_B, y_test_B)
+
+
+# The first 4 epochs only trained the output layer, on the cached outputs of the last frozen layer. The last 16 epochs trained the whole model, since all layers were trainable again. Task B's training set is tiny, so let's measure the speedup on a larger dataset: let's train a new output layer on top of the frozen layers of model A, using task A's training set (this is just for timing purposes). We time the second call to `fit()` in each case, so the cached version does not have to compute the features again, just like it would be the case when you train a new head for several rounds (e.g., to tune its hyperparameters):
+
+# In[166]:
+
+
+def build_frozen_model_on_A():
+    tf.random.set_seed(42)
+    model_A_clone = tf.keras.models.clone_model(model_A)
+    model_A_clone.set_weights(model_A.get_weights())
+    model = tf.keras.Sequential(model_A_clone.layers[:-1])
+    model.add(tf.keras.layers.Dense(8, activation="softmax"))
+    for layer in model.layers[:-1]:
+        layer.trainable = False
+    model.compile(loss="sparse_categorical_crossentropy",
+                  optimizer=tf.keras.optimizers.SGD(learning_rate=0.001),
+                  metrics=["accuracy"])
+    return model
+
+model = build_frozen_model_on_A()
+model.fit(X_train_A, y_train_A, epochs=1, verbose=0)
+get_ipython().run_line_magic('time', 'history = model.fit(X_train_A, y_train_A, epochs=5, verbose=0)')
+
+
+# In[167]:
+
+
+trainer = FrozenFeatureTrainer(build_frozen_model_on_A(), metrics=["accuracy"])
+trainer.fit(X_train_A, y_train_A, epochs=1, verbose=0)
+get_ipython().run_line_magic('time', 'history = trainer.fit(X_train_A, y_train_A, epochs=5, verbose=0)')